@@ -235,6 +235,7 @@ class FileParser:
                 self.insert_code_node(out_tree, groups["code"])
                 groups["file"].merge(groups["code"])
 
+            out_tree.root.finalize()
             out_tree.root.num_lines = groups["file"].end_line
             out_tree.root.total_sloc = groups["file"].line_count
             return out_tree
@@ -10,7 +10,10 @@ Contains classes that define:
 import collections
 import hashlib
 import logging
+import operator
 import os
+import re
+import sys
 from collections.abc import Callable, Iterable
 from copy import copy
 from enum import Enum
@@ -37,19 +40,60 @@ def toklist_print(toklist):
     return "".join(out)
 
 
-def _representation_string(obj, *, name=None, attrs=None):
+def _attribute_names(obj):
+    """
+    Helper function to list the attributes set on an object, in definition
+    order, whether stored in __slots__ or in __dict__.
+    """
+    attrs = []
+    for cls in reversed(type(obj).__mro__):
+        slots = cls.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        attrs.extend(a for a in slots if hasattr(obj, a))
+    attrs.extend(getattr(obj, "__dict__", {}))
+    return attrs
+
+
+def _representation_string(obj, *, name=None, attrs=None, values=None):
     """
     Helper function to build representation strings of the form:
     Name(attribute={attribute!r},...)
+
+    Values in the optional `values` dictionary are printed in place of the
+    corresponding attributes.
     """
     if not name:
         name = obj.__class__.__name__
     if not attrs:
-        attrs = obj.__dict__
-    properties = ",".join(f"{a}={getattr(obj, a)!r}" for a in attrs)
+        attrs = _attribute_names(obj)
+    if not values:
+        values = {}
+    properties = ",".join(
+        f"{a}={values.get(a, getattr(obj, a))!r}" for a in attrs
+    )
     return f"{name}({properties})"
 
 
+class _BoundedCache(dict):
+    """
+    A dictionary that discards its oldest entry when a new entry would
+    grow it beyond a maximum size. Used for caches that are shared by all
+    files and platforms, so that they cannot grow without limit.
+    """
+
+    __slots__ = ("maxsize",)
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        if key not in self and len(self) >= self.maxsize:
+            del self[next(iter(self))]
+        super().__setitem__(key, value)
+
+
 class TokenError(ValueError):
     """
     Represents an error encountered during tokenization.
@@ -73,6 +117,8 @@ class Token:
     Represents a token constructed by the parser.
     """
 
+    __slots__ = ("line", "col", "prev_white", "token")
+
     def __init__(self, line, col, prev_white, token):
         self.line = line
         self.col = col
@@ -105,6 +151,8 @@ class CharacterConstant(Token):
     Represents a character constant.
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -116,6 +164,8 @@ class NumericalConstant(Token):
     not be valid syntax).
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -125,6 +175,12 @@ class StringConstant(Token):
     Represents a string constant.
     """
 
+    __slots__ = ()
+
+    # The lexer only accepts a " inside a string when it is escaped, so
+    # escaping each character independently turns \" into \\\".
+    _sanitize_table = str.maketrans({"\\": "\\\\", '"': '\\"'})
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -139,20 +195,7 @@ class StringConstant(Token):
         """
         Return this string quoted for stringification.
         """
-        out = [r"\""]
-        c = 0
-        while c < len(self.token):
-            if self.token[c] == "\\":
-                if c + 1 < len(self.token) and self.token[c + 1] == '"':
-                    out.append(r"\\\"")
-                    c += 1
-                else:
-                    out.append("\\\\")
-            else:
-                out.append(self.token[c])
-            c += 1
-        out.append(r"\"")
-        return "".join(out)
+        return r"\"" + self.token.translate(self._sanitize_table) + r"\""
 
 
 class Identifier(Token):
@@ -160,6 +203,8 @@ class Identifier(Token):
     Represents a C identifier.
     """
 
+    __slots__ = ("expandable",)
+
     def __init__(self, line, col, prev_white, token):
         super().__init__(line, col, prev_white, token)
         self.expandable = True
@@ -173,6 +218,8 @@ class Operator(Token):
     Represents a C operator.
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -182,6 +229,8 @@ class Punctuator(Token):
     Represents a punctuator (e.g. parentheses)
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -191,6 +240,8 @@ class Unknown(Token):
     Represents an unknown token.
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return _representation_string(self)
 
@@ -200,6 +251,53 @@ class Lexer:
     A lexer for the C preprocessor grammar.
     """
 
+    # A single pattern matching optional whitespace followed by any token,
+    # with one named group per token type. The alternatives are tried in
+    # the same order as tokenize_one(), and match the same strings for
+    # ASCII input. The str methods used by the individual token methods
+    # (e.g. isdigit) also accept non-ASCII characters, so other input
+    # is tokenized one token at a time.
+    _token_pattern = re.compile(
+        r"""
+        (?P<whitespace>[ \t\n\r]*+)
+        (?:
+            (?P<number>\.?[0-9](?:[eEpP][+-]|[A-Za-z0-9_.])*)
+          | (?P<character>'(?>\\[ -~]|[ -~])')
+          | (?P<string>"(?:\\"|[^"])*+")
+          | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+          | (?P<operator>\|\||&&|>>|<<|!=|>=|<=|==|\#\#|[-+!*/|&^<>?:~\#=%])
+          | (?P<punctuator>[(){}\[\],.;'"\\])
+          | (?P<unknown>.)
+        )
+        """,
+        re.VERBOSE | re.DOTALL,
+    )
+    _whitespace_pattern = re.compile(r"[ \t\n\r]+")
+    # For str patterns, \w matches exactly the characters accepted by
+    # str.isalnum(), plus "_".
+    _word_pattern = re.compile(r"\w+")
+    # Operators grouped by their first character, longest first.
+    _operators_by_first = {
+        "|": ("||", "|"),
+        "&": ("&&", "&"),
+        ">": (">>", ">=", ">"),
+        "<": ("<<", "<=", "<"),
+        "!": ("!=", "!"),
+        "=": ("==", "="),
+        "#": ("##", "#"),
+    }
+    _operators_by_first.update((c, (c,)) for c in "-+*/^?:~%")
+    _punctuators = frozenset("(){}[],.;'\"\\")
+    _token_types = {
+        "number": NumericalConstant,
+        "character": CharacterConstant,
+        "string": StringConstant,
+        "identifier": Identifier,
+        "operator": Operator,
+        "punctuator": Punctuator,
+        "unknown": Unknown,
+    }
+
     def __init__(self, string, line="Unknown"):
         self.string = string
         self.line = line
@@ -222,8 +320,9 @@ class Lexer:
         """
         Consume whitespace and advance position.
         """
-        while not self.eos() and self.read() in [" ", "\t", "\n", "\r"]:
-            self.pos += 1
+        m = Lexer._whitespace_pattern.match(self.string, self.pos)
+        if m:
+            self.pos = m.end()
             self.prev_white = True
 
     def match(self, literal):
@@ -255,43 +354,33 @@ class Lexer:
         <exponent> := ['e'|'E'|'p'|'P']['+'|'-']
         <number> := .?<digit>[<alpha>|<digit>|'_'|'.'|<exponent>]*
         """
+        string = self.string
+        n = len(string)
         col = self.pos
-        try:
-            chars = []
+        pos = col
 
-            # Match optional period
-            if self.read() == ".":
-                chars.append(self.read())
-                self.pos += 1
+        # Match optional period
+        if pos < n and string[pos] == ".":
+            pos += 1
 
-            # Match required decimal digit
-            if self.read().isdigit():
-                chars.append(self.read())
-                self.pos += 1
+        # Match required decimal digit
+        if pos == n or not string[pos].isdigit():
+            raise TokenError("Invalid preprocessing number.")
+        pos += 1
+
+        # Match any sequence of letters, digits, underscores,
+        # periods and exponents
+        while pos < n:
+            c = string[pos]
+            if c in "eEpP" and pos + 1 < n and string[pos + 1] in "+-":
+                pos += 2
+            elif c.isalpha() or c.isdigit() or c == "_" or c == ".":
+                pos += 1
             else:
-                raise TokenError("Expected digit.")
-
-            # Match any sequence of letters, digits, underscores,
-            # periods and exponents
-            exponents = ["e+", "e-", "E+", "E-", "p+", "p-", "P+", "P-"]
-            while not self.eos():
-                if self.read(2) in exponents:
-                    chars.append(self.read(2))
-                    self.pos += 2
-                elif (
-                    self.read().isalpha()
-                    or self.read().isdigit()
-                    or self.read() in ["_", "."]
-                ):
-                    chars.append(self.read())
-                    self.pos += 1
-                else:
-                    break
+                break
 
-            value = "".join(chars)
-        except TokenError:
-            self.pos = col
-            raise TokenError("Invalid preprocessing number.")
+        value = string[col:pos]
+        self.pos = pos
 
         constant = NumericalConstant(self.line, col, self.prev_white, value)
         return constant
@@ -383,25 +472,20 @@ class Lexer:
         col = self.pos
 
         # Match a string of characters
-        characters = []
-        while not self.eos() and (self.read().isalnum() or self.read() == "_"):
-            # First character of an identifier cannot be a digit
-            if self.pos == col and self.read().isdigit():
-                self.pos = col
-                raise TokenError("Identifiers cannot start with a digit.")
-
-            characters += self.read()
-            self.pos += 1
-
-        if not characters:
-            self.pos = col
+        m = Lexer._word_pattern.match(self.string, col)
+        if not m:
             raise TokenError("Invalid identifier.")
 
+        # First character of an identifier cannot be a digit
+        if self.read().isdigit():
+            raise TokenError("Identifiers cannot start with a digit.")
+
+        self.pos = m.end()
         identifier = Identifier(
             self.line,
             col,
             self.prev_white,
-            "".join(characters),
+            sys.intern(m.group()),
         )
         return identifier
 
@@ -415,32 +499,11 @@ class Lexer:
                  '==' | '##' | '?' | ':' | '<' | '>' | '%']
         """
         col = self.pos
-        operators = ["||", "&&", ">>", "<<", "!=", ">=", "<=", "==", "##"] + [
-            "-",
-            "+",
-            "!",
-            "*",
-            "/",
-            "|",
-            "&",
-            "^",
-            "<",
-            ">",
-            "?",
-            ":",
-            "~",
-            "#",
-            "=",
-            "%",
-        ]
-        try:
-            index = self.match_any(operators)
-
-            op = Operator(self.line, col, self.prev_white, operators[index])
-            return op
-        except TokenError:
-            self.pos = col
-            raise TokenError("Invalid operator.")
+        for op in Lexer._operators_by_first.get(self.read(), ()):
+            if self.string.startswith(op, col):
+                self.pos += len(op)
+                return Operator(self.line, col, self.prev_white, op)
+        raise TokenError("Invalid operator.")
 
     def punctuator(self):
         """
@@ -450,52 +513,32 @@ class Lexer:
         <punc> := ['('|')'|'{'|'}'|'['|']'|','|'.'|';'|'''|'"'|'\']
         """
         col = self.pos
-        punctuators = [
-            "(",
-            ")",
-            "{",
-            "}",
-            "[",
-            "]",
-            ",",
-            ".",
-            ";",
-            "'",
-            '"',
-            "\\",
-        ]
-        try:
-            index = self.match_any(punctuators)
-
-            punc = Punctuator(
-                self.line,
-                col,
-                self.prev_white,
-                punctuators[index],
-            )
-            return punc
-        except TokenError:
-            self.pos = col
+        punc = self.read()
+        if punc not in Lexer._punctuators:
             raise TokenError("Invalid punctuator.")
+        self.pos += 1
+        return Punctuator(self.line, col, self.prev_white, punc)
 
     def tokenize_one(self):
         """
         Consume and return next token. Returns None if not possible.
         """
-        candidates = [
-            self.number,
-            self.character_constant,
-            self.string_constant,
-            self.identifier,
-            self.operator,
-            self.punctuator,
-        ]
+        c = self.read()
+        candidates = Lexer._candidates_by_first.get(c)
+        if candidates is None:
+            if c.isdigit():
+                candidates = (Lexer.number,)
+            elif c.isalnum() or c == "_":
+                candidates = (Lexer.identifier,)
+            else:
+                return None
+
         token = None
         for f in candidates:
             col = self.pos
             pws = self.prev_white
             try:
-                token = f()
+                token = f(self)
                 self.prev_white = False
                 break
             except TokenError:
@@ -503,10 +546,27 @@ class Lexer:
                 self.prev_white = pws
         return token
 
+    # The first character of a token determines which methods of
+    # tokenize_one() can match it. Digits and letters are handled
+    # separately, since str.isdigit() and str.isalnum() accept non-ASCII
+    # characters.
+    _candidates_by_first = {
+        ".": (number, punctuator),
+        "'": (character_constant, punctuator),
+        '"': (string_constant, punctuator),
+    }
+    _candidates_by_first.update(
+        dict.fromkeys(_operators_by_first, (operator,)),
+    )
+    _candidates_by_first.update(dict.fromkeys("(){}[],;\\", (punctuator,)))
+
     def tokenize(self):
         """
         Return a list of all tokens in the string.
         """
+        if self.string.isascii():
+            return self.__tokenize_ascii()
+
         tokens = []
         self.whitespace()
         while not self.eos():
@@ -532,6 +592,36 @@ class Lexer:
 
         return tokens
 
+    def __tokenize_ascii(self):
+        """
+        Return a list of all tokens in an ASCII string, using a single
+        regular expression to find each token.
+        """
+        tokens = []
+        line = self.line
+        prev_white = self.prev_white
+        token_types = Lexer._token_types
+        for m in Lexer._token_pattern.finditer(self.string, self.pos):
+            col = m.end("whitespace")
+            if col != m.start():
+                prev_white = True
+            kind = m.lastgroup
+            value = m.group(kind)
+            if kind == "character" or kind == "string":
+                value = value[1:-1]
+            elif kind in ("identifier", "operator", "punctuator"):
+                value = sys.intern(value)
+            tokens.append(token_types[kind](line, col, prev_white, value))
+            prev_white = False
+            self.pos = m.end()
+
+        # Anything left over is whitespace
+        if not self.eos():
+            self.pos = len(self.string)
+            prev_white = True
+        self.prev_white = prev_white
+        return tokens
+
 
 class ParseError(ValueError):
     """
@@ -550,37 +640,67 @@ class Node:
     Contains a single parent, and an ordered list of children.
     """
 
+    __slots__ = ("children", "parent")
+
     def __init__(self):
         self.children = []
         self.parent = None
 
     def add_child(self, child):
+        if isinstance(self.children, tuple):
+            # The tree has been finalized. Switch back to a list, so that
+            # appending more children does not copy the tuple each time.
+            self.children = list(self.children)
         self.children.append(child)
         child.parent = self
 
-    @staticmethod
-    def is_start_node():
+    def _representation(self, **kwargs):
+        """
+        Build a representation string for this node, printing its children
+        as a list whether or not the tree has been finalized.
+        """
+        values = {"children": list(self.children)}
+        return _representation_string(self, values=values, **kwargs)
+
+    def finalize(self):
+        """
+        Store the children of this node and all of its descendants as
+        tuples, once the tree is complete. Most nodes have no children,
+        and share the empty tuple instead of keeping an empty list.
+
+        Finalized trees are not expected to grow, but add_child() still
+        works: the children of the node are converted back to a list.
+        """
+        for node in self.walk():
+            node.children = tuple(node.children)
+
+    # Whether this node starts, continues or ends a tree.
+    # These are class attributes so that SourceTree can test them without
+    # a method call while building the tree.
+    _is_start = False
+    _is_cont = False
+    _is_end = False
+
+    def is_start_node(self):
         """
         Used to determine if a node is a start node of a tree.
         Return False by default.
         """
-        return False
+        return self._is_start
 
-    @staticmethod
-    def is_cont_node():
+    def is_cont_node(self):
         """
         Used to determine if a node is a continue node of a tree.
         Return False by default.
         """
-        return False
+        return self._is_cont
 
-    @staticmethod
-    def is_end_node():
+    def is_end_node(self):
         """
         Used to determine if a node is a end node of a tree.
         Return False by default.
         """
-        return False
+        return self._is_end
 
     def evaluate_for_platform(self, **kwargs):
         """
@@ -598,9 +718,11 @@ class Node:
             An Iterable visiting all descendants of this node via a preorder
             traversal.
         """
-        yield self
-        for child in self.children:
-            yield from child.walk()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
 
     def visit(self, visitor: Callable[[Self], Visit]):
         """
@@ -625,6 +747,8 @@ class FileNode(Node):
     inheriting from the Node class.
     """
 
+    __slots__ = ("filename", "num_lines", "total_sloc", "file_hash")
+
     def __init__(self, _filename):
         super().__init__()
         self.filename = _filename
@@ -664,6 +788,8 @@ class CodeNode(Node):
     the original source.
     """
 
+    __slots__ = ("start_line", "end_line", "num_lines", "lines", "source")
+
     def __init__(
         self,
         start_line=-1,
@@ -716,6 +842,8 @@ class DirectiveNode(CodeNode):
     countable lines and extent.
     """
 
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
@@ -725,13 +853,15 @@ class UnrecognizedDirectiveNode(DirectiveNode):
     A CodeNode representing an unrecognized preprocessor directive
     """
 
+    __slots__ = ("kind", "tokens")
+
     def __init__(self, tokens):
         super().__init__()
         self.kind = "unrecognized"
         self.tokens = tokens
 
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -746,13 +876,15 @@ class PragmaNode(DirectiveNode):
     Represents a #pragma directive
     """
 
+    __slots__ = ("kind", "tokens")
+
     def __init__(self, tokens):
         super().__init__()
         self.kind = "pragma"
         self.tokens = tokens
 
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -772,6 +904,8 @@ class DefineNode(DirectiveNode):
     A DirectiveNode representing a #define directive.
     """
 
+    __slots__ = ("kind", "identifier", "args", "value")
+
     def __init__(self, identifier, args=None, value=None):
         super().__init__()
         self.kind = "define"
@@ -780,7 +914,7 @@ class DefineNode(DirectiveNode):
         self.value = value
 
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -811,13 +945,15 @@ class UndefNode(DirectiveNode):
     A DirectiveNode representing an #undef directive.
     """
 
+    __slots__ = ("kind", "identifier")
+
     def __init__(self, identifier):
         super().__init__()
         self.kind = "undefine"
         self.identifier = identifier
 
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -868,13 +1004,15 @@ class IncludeNode(DirectiveNode):
     Its value is an IncludePath or a list of tokens.
     """
 
+    __slots__ = ("kind", "value")
+
     def __init__(self, value):
         super().__init__()
         self.kind = "include"
         self.value = value
 
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -932,22 +1070,56 @@ class IncludeNode(DirectiveNode):
             )
 
 
+def _macro_fingerprint(tokens, platform):
+    """
+    Return the definition of every macro that expanding `tokens` could
+    use, as a tuple of (name, definition) pairs. Names that are not defined
+    are included with a definition of None.
+
+    Return None if any of the macros can construct new identifiers via
+    token pasting, since the macros they name cannot be known in advance.
+    """
+    definitions = {}
+    pending = [t.token for t in tokens if isinstance(t, Identifier)]
+    while pending:
+        name = pending.pop()
+        if name in definitions:
+            continue
+        macro = platform.get_macro(name)
+        if macro is None:
+            definitions[name] = None
+            continue
+        definitions[name] = macro.definition()
+        if macro.has_strcat:
+            return None
+        pending.extend(
+            t.token for t in macro.replacement if isinstance(t, Identifier)
+        )
+    return tuple(sorted(definitions.items(), key=lambda item: item[0]))
+
+
 class IfNode(DirectiveNode):
     """
     Represents an #if, #ifdef or #ifndef directive.
     """
 
+    __slots__ = ("kind", "tokens")
+
+    _is_start = True
+
+    # Results of evaluate_for_platform(), keyed by the type and spelling of
+    # each token and the definitions of the macros they can expand to.
+    # Definitions are compared by spelling, since every platform and file
+    # creates its own Macro objects.
+    _evaluate_cache = _BoundedCache(4096)
+
     def __init__(self, tokens):
         super().__init__()
         self.kind = "if"
         self.tokens = tokens
 
-    @staticmethod
-    def is_start_node():
-        return True
-
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -958,11 +1130,27 @@ class IfNode(DirectiveNode):
         return [f"#if {rest}"]
 
     def evaluate_for_platform(self, **kwargs):
+        platform = kwargs["platform"]
+
+        # Identical expressions (e.g. include guards) are common, and give
+        # the same result whenever the macros they use are the same.
+        fingerprint = _macro_fingerprint(self.tokens, platform)
+        if fingerprint is not None:
+            key = (tuple((type(t), t.token) for t in self.tokens), fingerprint)
+            try:
+                return IfNode._evaluate_cache[key]
+            except KeyError:
+                pass
+
         # Perform macro substitution with tokens
-        expanded_tokens = MacroExpander(kwargs["platform"]).expand(self.tokens)
+        expanded_tokens = MacroExpander(platform).expand(self.tokens)
 
         # Evaluate the expanded tokens
-        return ExpressionEvaluator(expanded_tokens).evaluate()
+        result = ExpressionEvaluator(expanded_tokens).evaluate()
+
+        if fingerprint is not None:
+            IfNode._evaluate_cache[key] = result
+        return result
 
 
 class ElIfNode(IfNode):
@@ -970,34 +1158,31 @@ class ElIfNode(IfNode):
     Represents an #elif directive.
     """
 
+    __slots__ = ()
+
+    _is_start = False
+    _is_cont = True
+
     def __init__(self, tokens):
         super().__init__(tokens)
         self.kind = "elif"
 
-    @staticmethod
-    def is_start_node():
-        return False
-
-    @staticmethod
-    def is_cont_node():
-        return True
-
 
 class ElseNode(DirectiveNode):
     """
     Represents an #else directive.
     """
 
+    __slots__ = ("kind",)
+
+    _is_cont = True
+
     def __init__(self):
         super().__init__()
         self.kind = "else"
 
-    @staticmethod
-    def is_cont_node():
-        return True
-
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -1015,16 +1200,16 @@ class EndIfNode(DirectiveNode):
     Represents an #endif directive.
     """
 
+    __slots__ = ("kind",)
+
+    _is_end = True
+
     def __init__(self):
         super().__init__()
         self.kind = "endif"
 
-    @staticmethod
-    def is_end_node():
-        return True
-
     def __repr__(self):
-        return _representation_string(self, name="DirectiveNode")
+        return self._representation(name="DirectiveNode")
 
     def spelling(self):
         """
@@ -1039,6 +1224,8 @@ class Parser:
     A generic token parser for matching tokens from a list.
     """
 
+    __slots__ = ("tokens", "pos")
+
     def __init__(self, tokens):
         self.tokens = tokens
         self.pos = 0
@@ -1084,43 +1271,84 @@ class Parser:
             raise ParseError(f"Expected {token_value!s}.")
         return token
 
+    def try_match_type(self, token_type):
+        """
+        Match a token of the specified type and advance position.
+        Return None without advancing if the token does not match.
+        """
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if isinstance(token, token_type):
+                self.pos += 1
+                return token
+        return None
+
+    def try_match_value(self, token_type, token_value):
+        """
+        Match a token of the specified type and value, and advance
+        position. Return None without advancing if the token does not
+        match.
+        """
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if isinstance(token, token_type) and token.token == token_value:
+                self.pos += 1
+                return token
+        return None
+
 
 class DirectiveParser(Parser):
     """
     A specialized token parser for recognizing directives.
     """
 
+    __slots__ = ()
+
+    # Tokens wrapping the identifier of an #ifdef or #ifndef directive.
+    # These are shared by every IfNode built from those directives, and
+    # are never modified by macro expansion or evaluation.
+    _defined_prefix = (
+        Identifier("Unknown", -1, True, "defined"),
+        Punctuator("Unknown", -1, False, "("),
+    )
+    _not_defined_prefix = (
+        Operator("Unknown", -1, True, "!"),
+        Identifier("Unknown", -1, False, "defined"),
+        Punctuator("Unknown", -1, False, "("),
+    )
+    _defined_suffix = (Punctuator("Unknown", -1, False, ")"),)
+
     def __arg(self):
         """
         Match an Identifier, Identifier... or ...
+        Return None if there is no argument.
 
         <arg> := <identifier>?'...'
         """
-        arg = None
-
         # Match optional identifier
-        initial_pos = self.pos
-        try:
-            arg = self.match_type(Identifier)
-        except ParseError:
-            self.pos = initial_pos
+        arg = self.try_match_type(Identifier)
 
         # Match optional '...'
         ellipsis_pos = self.pos
-        try:
-            punc = self.match_value(Punctuator, ".")
-            self.match_value(Punctuator, ".")
-            self.match_value(Punctuator, ".")
-            if arg is None:
-                arg = Identifier(punc.line, punc.col, punc.prev_white, "...")
+        punc = self.try_match_value(Punctuator, ".")
+        if punc is not None:
+            if (
+                self.try_match_value(Punctuator, ".") is not None
+                and self.try_match_value(Punctuator, ".") is not None
+            ):
+                if arg is None:
+                    arg = Identifier(
+                        punc.line,
+                        punc.col,
+                        punc.prev_white,
+                        "...",
+                    )
+                else:
+                    arg.token += "..."
             else:
-                arg.token += "..."
-        except ParseError:
-            self.pos = ellipsis_pos
+                self.pos = ellipsis_pos
 
-        if arg is not None:
-            return arg
-        raise ParseError("Invalid argument")
+        return arg
 
     def __arg_list(self):
         """
@@ -1130,22 +1358,15 @@ class DirectiveParser(Parser):
         <arg-list> := [<arg>[','<arg>]*]?
         """
         args = []
-        try:
-            arg = self.__arg()
+        arg = self.__arg()
+        while arg is not None:
             args.append(arg)
             if arg.token.endswith("..."):
-                return args
-
-            while True:
-                self.match_value(Punctuator, ",")
-
-                arg = self.__arg()
-                args.append(arg)
-                if arg.token.endswith("..."):
-                    return args
-
-        except ParseError:
-            return args
+                break
+            if self.try_match_value(Punctuator, ",") is None:
+                break
+            arg = self.__arg()
+        return args
 
     def macro_definition(self):
         """
@@ -1155,20 +1376,17 @@ class DirectiveParser(Parser):
         identifier = self.match_type(Identifier)
 
         # Match function-like macro definitions
+        # Read a list of arguments between parentheses.
+        # whitespace is NOT permitted before the opening paren.
         arg_pos = self.pos
-        try:
-            # Read a list of arguments between parentheses.
-            # whitespace is NOT permitted before the opening paren.
-            punctuator = self.match_value(Punctuator, "(")
-            if punctuator.prev_white:
-                raise ParseError("Not a function-like macro.")
+        punctuator = self.try_match_value(Punctuator, "(")
+        if punctuator is not None and not punctuator.prev_white:
             args = self.__arg_list()
-            punctuator = self.match_value(Punctuator, ")")
-        except ParseError:
-            args = None
-            self.pos = arg_pos
+            if self.try_match_value(Punctuator, ")") is not None:
+                return (identifier, args)
+        self.pos = arg_pos
 
-        return (identifier, args)
+        return (identifier, None)
 
     def define(self):
         """
@@ -1268,25 +1486,26 @@ class DirectiveParser(Parser):
         <include-path> := ['<'<path>'>'|'\"'<path>'>']
         """
         initial_pos = self.pos
+        token = None if self.eol() else self.cursor()
 
         # Match system include
-        try:
-            path_tokens = self.__path(Operator, "<", ">")
-            path_str = "".join([str(t) for t in path_tokens])
-            if util.valid_path(path_str):
-                return IncludePath(path_str, system=True)
-        except ParseError:
-            self.pos = initial_pos
+        if isinstance(token, Operator) and token.token == "<":
+            try:
+                path_tokens = self.__path(Operator, "<", ">")
+                path_str = "".join([str(t) for t in path_tokens])
+                if util.valid_path(path_str):
+                    return IncludePath(path_str, system=True)
+            except ParseError:
+                pass
 
         # Match local include
-        try:
-            path_token = self.match_type(StringConstant)
-            path_str = path_token.token
+        elif isinstance(token, StringConstant):
+            self.pos += 1
+            path_str = token.token
             if util.valid_path(path_str):
                 return IncludePath(path_str, system=False)
-        except ParseError:
-            self.pos = initial_pos
 
+        self.pos = initial_pos
         raise ParseError("Invalid path.")
 
     def pragma(self):
@@ -1338,12 +1557,11 @@ class DirectiveParser(Parser):
             identifier = self.match_type(Identifier)
 
             # Wrap expression in "defined()" call
-            prefix = [
-                Identifier("Unknown", -1, True, "defined"),
-                Punctuator("Unknown", -1, False, "("),
+            expr = [
+                *DirectiveParser._defined_prefix,
+                identifier,
+                *DirectiveParser._defined_suffix,
             ]
-            suffix = [Punctuator("Unknown", -1, False, ")")]
-            expr = prefix + [identifier] + suffix
 
             return IfNode(expr)
         except ParseError:
@@ -1363,13 +1581,11 @@ class DirectiveParser(Parser):
             identifier = self.match_type(Identifier)
 
             # Wrap expression in "!defined()" call
-            prefix = [
-                Operator("Unknown", -1, True, "!"),
-                Identifier("Unknown", -1, False, "defined"),
-                Punctuator("Unknown", -1, False, "("),
+            expr = [
+                *DirectiveParser._not_defined_prefix,
+                identifier,
+                *DirectiveParser._defined_suffix,
             ]
-            suffix = [Punctuator("Unknown", -1, False, ")")]
-            expr = prefix + [identifier] + suffix
 
             return IfNode(expr)
         except ParseError:
@@ -1424,6 +1640,20 @@ class DirectiveParser(Parser):
             self.pos = initial_pos
             raise ParseError("Invalid endif directive.")
 
+    # The method matching each directive, keyed by its name.
+    _directives = {
+        "define": define,
+        "undef": undef,
+        "include": include,
+        "ifdef": ifdef,
+        "ifndef": ifndef,
+        "if": if_,
+        "elif": elif_,
+        "else": else_,
+        "endif": endif,
+        "pragma": pragma,
+    }
+
     def parse(self):
         """
         Parse a preprocessor directive.
@@ -1434,36 +1664,32 @@ class DirectiveParser(Parser):
         """
         try:
             self.match_value(Operator, "#")
-
-            # Check for a match against known directives
-            candidates = [
-                self.define,
-                self.undef,
-                self.include,
-                self.ifdef,
-                self.ifndef,
-                self.if_,
-                self.elif_,
-                self.else_,
-                self.endif,
-                self.pragma,
-            ]
-            for f in candidates:
-                try:
-                    directive = f()
-                    if not self.eol():
-                        chars = "".join(str(x) for x in self.tokens)
-                        log.warning(
-                            f"Additional tokens at end of directive: {chars}",
-                        )
-                    return directive
-                except ParseError:
-                    pass
-
-            return UnrecognizedDirectiveNode(self.tokens)
         except ParseError:
             raise ParseError("Not a directive.")
 
+        # Check for a match against the directive named by the next token
+        f = None
+        if not self.eol() and isinstance(self.cursor(), Identifier):
+            f = DirectiveParser._directives.get(self.cursor().token)
+        if f is not None:
+            try:
+                directive = f(self)
+                if not self.eol():
+                    chars = "".join(str(x) for x in self.tokens)
+                    log.warning(
+                        f"Additional tokens at end of directive: {chars}",
+                    )
+                return directive
+            except ParseError:
+                pass
+
+        return UnrecognizedDirectiveNode(self.tokens)
+
+
+# The expansion of a macro defined without a value (e.g. -DMACRO).
+# Tokens in a replacement are copied before they are modified.
+_default_expansion = NumericalConstant("Unknown", None, False, "1")
+
 
 def macro_from_definition_string(string):
     """
@@ -1481,7 +1707,7 @@ def macro_from_definition_string(string):
         expansion = parser.tokens[parser.pos :]
         parser.pos = len(parser.tokens)
     else:
-        expansion = [NumericalConstant("Unknown", None, False, "1")]
+        expansion = [_default_expansion]
 
     return make_macro(identifier, args, expansion)
 
@@ -1496,14 +1722,48 @@ def make_macro(identifier, args, expansion):
         return MacroFunction(identifier, args, expansion)
 
 
+# Results of _concatenated_token(), keyed by spelling.
+_concatenated_tokens = _BoundedCache(4096)
+
+
+def _concatenated_token(spelling):
+    """
+    Return the first token of a string formed by the ## operator, or None.
+    """
+    try:
+        return _concatenated_tokens[spelling]
+    except KeyError:
+        pass
+    tok = Lexer(spelling).tokenize_one()
+    _concatenated_tokens[spelling] = tok
+    return tok
+
+
+def _concatenate(left, right):
+    """
+    Return a new token formed by pasting two spellings with ##.
+    The same spellings are often pasted repeatedly (e.g. by X-macros),
+    so the token is lexed once and copied.
+    """
+    spelling = left + right
+    tok = _concatenated_token(spelling)
+    if tok is None:
+        raise ParseError(f"Invalid concatenation: {spelling}")
+    return copy(tok)
+
+
 class Macro:
     """
     Represents a macro definition.
     """
 
+    __slots__ = ("name", "replacement", "has_strcat", "_definition")
+
     def __init__(self, name, replacement):
         self.name = name.token
         self.replacement = replacement
+        self.has_strcat = False
+        self._definition = None
 
         if isinstance(self.replacement, list) and len(self.replacement) > 0:
             if self.replacement[0].token == "##":
@@ -1547,12 +1807,7 @@ class Macro:
                     res_tokens.append(nexttok)
                     self.has_strcat = True
                     continue
-                lex = Lexer(last.token + nexttok.token)
-                tok = lex.tokenize_one()
-                if tok is None:
-                    raise ParseError(
-                        f"Invalid concatenation: {lex.string}",
-                    )
+                tok = _concatenate(last.token, nexttok.token)
                 tok.prev_white = last.prev_white
             elif tok.token == "#":
                 if isinstance(self, MacroFunction):
@@ -1565,8 +1820,29 @@ class Macro:
             res_tokens.append(tok)
         self.replacement = res_tokens
 
+    def definition(self):
+        """
+        Return a hashable representation of this Macro's definition.
+        Macros with equal definitions always expand to the same tokens.
+        """
+        if self._definition is None:
+            self._definition = (
+                self.name,
+                self._parameters(),
+                tuple(
+                    (type(t), t.token, t.prev_white) for t in self.replacement
+                ),
+            )
+        return self._definition
+
+    def _parameters(self):
+        """
+        Return a hashable representation of this Macro's parameters.
+        """
+        return None
+
     def __repr__(self):
-        return _representation_string(self)
+        return _representation_string(self, attrs=["name", "replacement"])
 
     def spelling(self):
         """
@@ -1588,9 +1864,10 @@ class MacroFunction(Macro):
     Represents a macro function definition.
     """
 
+    __slots__ = ("args", "variadic", "arg_needs_expansion", "arg_index")
+
     def __init__(self, name, args, replacement):
         self.args = [x.token for x in args]
-        self.has_strcat = False
         if len(self.args) > 0:
             self.variadic = self.args[-1].endswith("...")
         else:
@@ -1603,16 +1880,24 @@ class MacroFunction(Macro):
                 # Strip '...' from argument name
                 self.args[-1] = self.args[-1][:-3]
         self.arg_needs_expansion = [False for x in self.args]
+
+        # The index of each argument, keyed by name.
+        self.arg_index = {}
+        for index, arg in enumerate(self.args):
+            self.arg_index.setdefault(arg, index)
         super().__init__(name, replacement)
 
     def which_arg(self, tok):
         """
         Returns index token occupies in this Macro's list. -1 if not found.
         """
-        try:
-            return self.args.index(tok)
-        except ValueError:
-            return -1
+        return self.arg_index.get(tok, -1)
+
+    def _parameters(self):
+        """
+        Return a hashable representation of this Macro's parameters.
+        """
+        return (tuple(self.args), self.variadic)
 
     def __repr__(self):
         return _representation_string(
@@ -1636,20 +1921,29 @@ class MacroFunction(Macro):
         pre-expanded) arguments passed to this.
         """
         # Combine variadic arguments into one, separated by commas
+        # Variadic arguments are only pre-expanded if the replacement
+        # requires it; see MacroExpander.expand.
         if self.variadic:
             comma = Punctuator("EXPANSION", -1, False, ",")
+            needs_expansion = self.arg_needs_expansion[-1]
             va_args_raw = []
             va_args_exp = []
             for idx in range(len(self.args) - 1, len(input_args) - 1):
                 va_args_raw.extend(input_args[idx][0])
                 va_args_raw.append(comma)
-                va_args_exp.extend(input_args[idx][1])
-                va_args_exp.append(comma)
+                if needs_expansion:
+                    va_args_exp.extend(input_args[idx][1])
+                    va_args_exp.append(comma)
             if len(self.args) - 1 < len(input_args):
                 va_args_raw.extend(input_args[-1][0])
-                va_args_exp.extend(input_args[-1][1])
+                if needs_expansion:
+                    va_args_exp.extend(input_args[-1][1])
 
-            input_args[len(self.args) - 1 :] = [(va_args_raw, va_args_exp)]
+            if needs_expansion:
+                va_args = (va_args_raw, va_args_exp)
+            else:
+                va_args = (va_args_raw,)
+            input_args[len(self.args) - 1 :] = [va_args]
 
         if self.has_strcat:
             res_tokens = []
@@ -1661,28 +1955,22 @@ class MacroFunction(Macro):
                 if tok.token == "##":
                     last = res_tokens.pop()
                     prev_white = last.prev_white
+                    argidx = None
                     if not last_cat:
-                        try:
-                            argidx = self.args.index(last.token)
-                            last = input_args[argidx][0]  # Unexpanded arg
-                        except ValueError:
-                            last = [last]
+                        argidx = self.arg_index.get(last.token)
+                    if argidx is not None:
+                        last = input_args[argidx][0]  # Unexpanded arg
                     else:
                         last = [last]
                     idx += 1
                     nexttok = self.replacement[idx]
-                    try:
-                        argidx = self.args.index(nexttok.token)
+                    argidx = self.arg_index.get(nexttok.token)
+                    if argidx is not None:
                         nexttok = input_args[argidx][0]  # Unexpanded arg
-                    except ValueError:
+                    else:
                         nexttok = [nexttok]
                     if len(last) > 0:
-                        lex = Lexer(last[-1].token + nexttok[0].token)
-                        tok = lex.tokenize_one()
-                        if tok is None:
-                            raise ParseError(
-                                f"Invalid concatenation: {lex.string}",
-                            )
+                        tok = _concatenate(last[-1].token, nexttok[0].token)
                         tok.prev_white = last[-1].prev_white
                         toadd = last[:-1] + [tok] + nexttok[1:]
                         if toadd[0].prev_white != prev_white:
@@ -1700,13 +1988,12 @@ class MacroFunction(Macro):
                             "Found # at end of macro replacement!",
                         )
                     nexttok = self.replacement[idx]
-                    try:
-                        argidx = self.args.index(nexttok.token)
-                        tok = input_args[argidx][0]  # Unexpanded arg
-                    except ValueError:
+                    argidx = self.arg_index.get(nexttok.token)
+                    if argidx is None:
                         raise ParseError(
                             "# was not followed by a macro argument.",
                         )
+                    tok = input_args[argidx][0]  # Unexpanded arg
                     tok = Lexer.stringify(tok)
                     tok.prev_white = tok.prev_white
                     last_cat = True
@@ -1716,23 +2003,25 @@ class MacroFunction(Macro):
                     res_tokens.append(tok)
                 idx += 1
         else:
-            res_tokens = copy(self.replacement)
+            # The replacement is only read, so it does not need to be copied.
+            res_tokens = self.replacement
 
         # Substitute each occurrence of an argument in the replacement
         substituted_tokens = []
+        arg_index = self.arg_index
         for token in res_tokens:
-            substitution = []
-
             # If a token matches an argument, it is substituted;
-            # otherwise it passes through
-            try:
-                substitution = input_args[self.args.index(token.token)][1]
-                if len(substitution) > 0:
-                    substitution[0] = copy(substitution[0])
-                    substitution[0].prev_white = token.prev_white
-            except (ValueError, ParseError):
-                substitution = [token]
-
+            # otherwise it passes through.
+            # Arguments that were not pre-expanded are substituted as-is.
+            argidx = arg_index.get(token.token)
+            if argidx is None:
+                substituted_tokens.append(token)
+                continue
+
+            substitution = input_args[argidx][-1]
+            if len(substitution) > 0:
+                substitution[0] = copy(substitution[0])
+                substitution[0].prev_white = token.prev_white
             substituted_tokens.extend(substitution)
 
         return substituted_tokens
@@ -1741,11 +2030,18 @@ class MacroFunction(Macro):
 class ExpanderHelper:
     """
     Class to act as token stream for expansion stack.
+
+    Tokens that have not been read yet are stored in reverse order, so
+    that reading a token or splicing in the tokens of another stream
+    only touches the front of the stream. Tokens that have been read and
+    kept are appended to the output.
     """
 
+    __slots__ = ("tokens", "output", "pre_expand")
+
     def __init__(self, tokens):
-        self.tokens = copy(tokens)
-        self.pos = 0
+        self.tokens = list(reversed(tokens))
+        self.output = []
         self.pre_expand = False
 
     def eol(self):
@@ -1753,48 +2049,51 @@ class ExpanderHelper:
         Returns boolean value of the read point being past end of stream.
         """
 
-        return self.pos >= len(self.tokens)
+        return not self.tokens
 
     def splice(self, upper_helper):
         """
-        Insert upper_helper ExpanderHelper into this
-        stream's pos, advancing pos to end of insertion.
+        Insert the output of upper_helper ExpanderHelper into this
+        stream's pos, so that it is read next.
         """
 
-        start = list(filter(None, self.tokens[: self.pos]))
-
-        self.tokens = (
-            start
-            + list(filter(None, upper_helper.tokens))
-            + list(filter(None, self.tokens[self.pos :]))
-        )
-        self.pos = len(start)
+        self.tokens.extend(reversed(upper_helper.output))
 
     def peek_tok(self):
         """
         Return at the current token without advancing.
         """
 
-        t = self.tokens[self.pos]
-        return t
+        return self.tokens[-1]
 
     def consume_tok(self):
         """
         Consume the current token, advance, and return it.
         """
 
-        t = self.tokens[self.pos]
-        self.tokens[self.pos] = None
-        self.pos += 1
-        return t
+        return self.tokens.pop()
 
     def replace_tok(self, item):
         """
         Replace the token at the current position with item. Advance.
         """
 
-        self.tokens[self.pos] = item
-        self.pos += 1
+        self.tokens.pop()
+        self.output.append(item)
+
+    def skip_tok(self):
+        """
+        Keep the token at the current position. Advance.
+        """
+
+        self.output.append(self.tokens.pop())
+
+    def keep_tok(self, item):
+        """
+        Keep item in place of the token that was consumed last.
+        """
+
+        self.output.append(item)
 
 
 class MacroExpander:
@@ -1802,10 +2101,17 @@ class MacroExpander:
     A specialized token parser for recognizing and expanding macros.
     """
 
+    # The result of an expansion that exceeds max_level. Callers copy
+    # tokens from an expansion before modifying them.
+    _overflow_token = NumericalConstant("EXPANSION", -1, False, "0")
+
     def __init__(self, platform):
         self.platform = platform
         self.parser_stack = []
         self.no_expand = []
+        # Reference counts for the identifiers in no_expand, allowing
+        # not_expandable to test membership without scanning the stack.
+        self.no_expand_counts = {}
 
         # Prevent infinite recursion. CPP standard requires this be at
         # least 15, but cpp has been implemented to handle 200.
@@ -1820,7 +2126,7 @@ class MacroExpander:
             raise EndofParse("Hit end of input streams")
         top_toks = self.parser_stack[-1]
         self.parser_stack.pop()
-        self.no_expand.pop()
+        self.pop_no_expand()
         self.parser_stack[-1].splice(top_toks)
 
     def push(self, tokens, ident=None):
@@ -1829,9 +2135,9 @@ class MacroExpander:
         stack.
         """
         self.parser_stack.append(ExpanderHelper(tokens))
-        self.parser_stack[-1].pre_expand = False
-        self.no_expand.append(ident)
-        self.overflow_check()
+        self.push_no_expand(ident)
+        if len(self.parser_stack) >= self.max_level:
+            raise MacroExpandOverflow
 
     def advance_tok(self):
         """
@@ -1840,7 +2146,7 @@ class MacroExpander:
         """
         while self.parser_stack[-1].eol():
             self.pop()
-        self.parser_stack[-1].pos += 1
+        self.parser_stack[-1].skip_tok()
 
     def peek_tok_pop(self):
         """
@@ -1891,11 +2197,29 @@ class MacroExpander:
         if len(self.parser_stack) >= self.max_level:
             raise MacroExpandOverflow
 
+    def push_no_expand(self, ident):
+        """
+        Add ident to the no-expansion list.
+        """
+        self.no_expand.append(ident)
+        self.no_expand_counts[ident] = self.no_expand_counts.get(ident, 0) + 1
+
+    def pop_no_expand(self):
+        """
+        Remove the most recently added ident from the no-expansion list.
+        """
+        ident = self.no_expand.pop()
+        count = self.no_expand_counts[ident] - 1
+        if count == 0:
+            del self.no_expand_counts[ident]
+        else:
+            self.no_expand_counts[ident] = count
+
     def not_expandable(self, ident):
         """
         Return if this token is in the no-expansion list.
         """
-        return not ident.expandable or ident.token in self.no_expand
+        return not ident.expandable or ident.token in self.no_expand_counts
 
     def defined(self, identifier):
         """
@@ -1909,6 +2233,48 @@ class MacroExpander:
             value,
         )
 
+    def __read_args(self):
+        """
+        Consume the arguments of a macro call, up to and including the
+        closing parenthesis. Return a list of the tokens in each argument.
+        """
+        # Usually the whole call is in the current stream, and can be
+        # removed from it at once instead of consuming tokens one at a
+        # time. Otherwise, the call continues into the streams below.
+        tokens = self.parser_stack[-1].tokens
+        next_tok = self.consume_tok
+        open_paren_count = 1
+        for i in range(len(tokens) - 1, -1, -1):
+            if tokens[i].token == "(":
+                open_paren_count += 1
+            elif tokens[i].token == ")":
+                open_paren_count -= 1
+                if open_paren_count == 0:
+                    next_tok = reversed(tokens[i:]).__next__
+                    del tokens[i:]
+                    break
+
+        args = []
+        current_arg = []
+        open_paren_count = 1
+        while True:
+            tok = next_tok()
+            if tok.token == "," and open_paren_count == 1:
+                args.append(current_arg)
+                current_arg = []
+                continue
+
+            if tok.token == "(":
+                open_paren_count += 1
+            elif tok.token == ")":
+                open_paren_count -= 1
+                if open_paren_count == 0:
+                    args.append(current_arg)
+                    break
+
+            current_arg.append(tok)
+        return args
+
     def expand(self, tokens, ident=None, pre_expand=False):
         """
         Expand a list of input tokens using the specified definitions.
@@ -1920,19 +2286,34 @@ class MacroExpander:
         if len(tokens) == 0:
             return tokens
 
+        # Only identifiers can be expanded.
+        if not any(isinstance(t, Identifier) for t in tokens):
+            return list(tokens)
+
         self.parser_stack.append(ExpanderHelper(tokens))
         self.parser_stack[-1].pre_expand = pre_expand
-        self.no_expand.append(str(ident))
+        self.push_no_expand(str(ident))
 
+        get_macro = self.platform.get_macro
         try:
             while True:
-                ctok = self.peek_tok_pop()
+                # The helper that ctok is consumed from, used to put back
+                # tokens that are not expanded. Tokens are read from it
+                # directly, since most are not identifiers and are skipped.
+                top = self.parser_stack[-1]
+                if not top.tokens:
+                    # The end of the input is the usual way out of the
+                    # loop, so test for it here instead of via EndofParse.
+                    if len(self.parser_stack) == 1 or top.pre_expand:
+                        break
+                    self.pop()
+                    continue
 
+                ctok = top.tokens.pop()
                 if not isinstance(ctok, Identifier):
-                    self.advance_tok()
+                    top.output.append(ctok)
                     continue
 
-                _ = self.consume_tok()
                 if ctok.token == "defined":
                     try:
                         tok = self.peek_tok()
@@ -1960,51 +2341,36 @@ class MacroExpander:
                 if self.not_expandable(ctok):
                     itok = copy(ctok)
                     itok.expandable = False
-                    self.parser_stack[-1].pos -= 1
-                    self.replace_tok(itok)
+                    top.keep_tok(itok)
                     continue
 
-                macro_lookup = self.platform.get_macro(ctok.token)
+                macro_lookup = get_macro(ctok.token)
                 if not macro_lookup:
-                    self.parser_stack[-1].pos -= 1
-                    self.replace_tok(ctok)
+                    top.keep_tok(ctok)
                     continue
 
                 if isinstance(macro_lookup, MacroFunction):
                     paren = self.peek_tok()
                     if not paren or paren.token != "(":
-                        self.parser_stack[-1].pos -= 1
-                        self.replace_tok(ctok)
+                        top.keep_tok(ctok)
                         continue
                     else:
                         _ = self.consume_tok()
-                    args = []
-                    current_arg = []
-                    open_paren_count = 1
-
-                    while True:
-                        tok = self.consume_tok()
-                        if tok.token == "," and open_paren_count == 1:
-                            args.append(current_arg)
-                            current_arg = []
-                            continue
-
-                        if tok.token == "(":
-                            open_paren_count += 1
-                        elif tok.token == ")":
-                            open_paren_count -= 1
-                            if open_paren_count == 0:
-                                args.append(current_arg)
-                                break
-
-                        current_arg.append(tok)
+                    args = self.__read_args()
 
+                    # Only pre-expand arguments that the replacement uses
+                    # in expanded form. Additional arguments are combined
+                    # into the variadic argument (if any) or are unused.
+                    arg_needs_expansion = macro_lookup.arg_needs_expansion
                     pre_expanded = []
                     for i, arg in enumerate(args):
-                        if (
-                            i >= len(macro_lookup.arg_needs_expansion)
-                            or macro_lookup.arg_needs_expansion[i]
-                        ):
+                        if i < len(arg_needs_expansion):
+                            needs_expansion = arg_needs_expansion[i]
+                        elif macro_lookup.variadic:
+                            needs_expansion = arg_needs_expansion[-1]
+                        else:
+                            needs_expansion = False
+                        if needs_expansion:
                             arg_expansion = self.expand(
                                 arg,
                                 ident=None,
@@ -2028,13 +2394,16 @@ class MacroExpander:
                 else:
                     raise ParseError("Unexpected error in macro expansion")
         except EndofParse:
-            res_tokens = list(filter(None, self.parser_stack[-1].tokens))
-            self.parser_stack.pop()
-            self.no_expand.pop()
-            return res_tokens
+            # Reached the end of the input while reading a macro call.
+            pass
         except MacroExpandOverflow:
             self.__init__(self.platform)
-            return [NumericalConstant("EXPANSION", -1, False, "0")]
+            return [MacroExpander._overflow_token]
+
+        res_tokens = self.parser_stack[-1].output
+        self.parser_stack.pop()
+        self.pop_no_expand()
+        return res_tokens
 
 
 class ExpressionEvaluator(Parser):
@@ -2042,6 +2411,8 @@ class ExpressionEvaluator(Parser):
     A specialized token parser for recognizing/evaluating expressions.
     """
 
+    __slots__ = ("kinds",)
+
     # Operator precedence, associativity and Python equivalent
     # Lower numbers = higher precedence
     # Based on:
@@ -2075,6 +2446,60 @@ class ExpressionEvaluator(Parser):
         "%": OpInfo(11, "LEFT"),
     }
 
+    # Python equivalent of each operator.
+    # && and || return one of their operands, like Python's "and" and "or".
+    _unary_functions = {
+        "-": operator.neg,
+        "+": operator.pos,
+        "!": operator.not_,
+        "~": operator.invert,
+    }
+    _binary_functions = {
+        "||": lambda lhs, rhs: lhs or rhs,
+        "&&": lambda lhs, rhs: lhs and rhs,
+        "|": operator.or_,
+        "^": operator.xor,
+        "&": operator.and_,
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<<": operator.lshift,
+        ">>": operator.rshift,
+        "+": operator.add,
+        "-": operator.sub,
+        "*": operator.mul,
+        # Division and modulo by zero always evaluate to zero. numpy also
+        # gives zero when both operands have the same signedness, but
+        # promotes mixed signed/unsigned operands to floating-point and
+        # gives inf or nan (i.e. true), so the result no longer depends on
+        # the signedness of the operands.
+        "/": lambda lhs, rhs: lhs // rhs if rhs else lhs * 0,
+        "%": lambda lhs, rhs: lhs % rhs if rhs else lhs * 0,
+    }
+
+    # Integer constant prefixes and suffixes. The longest suffix is
+    # matched, since alternatives are tried at each position in turn.
+    _bases = {"0x": 16, "0X": 16, "0b": 2, "0B": 2}
+    _suffix_pattern = re.compile(r"(?:ull|ULL|ul|UL|ll|LL|u|U|l|L)\Z")
+
+    # Values of integer constants, keyed by spelling.
+    _constant_cache = _BoundedCache(4096)
+
+    # Results of evaluate(), keyed by the type and spelling of each token.
+    _evaluate_cache = _BoundedCache(4096)
+
+    def __init__(self, tokens):
+        super().__init__(tokens)
+
+        # The type and spelling of each token, followed by a sentinel for
+        # the end of the list, so that the parser can examine tokens
+        # without isinstance checks or bounds checks.
+        self.kinds = [(type(t), t.token) for t in tokens]
+        self.kinds.append((None, None))
+
     def call(self):
         """
         Match a built-in call or function-like macro and return 0.
@@ -2082,20 +2507,22 @@ class ExpressionEvaluator(Parser):
         <call> := <identifier>'('<expression-list>?')'
         """
         initial_pos = self.pos
-        try:
-            self.match_type(Identifier)
+        if self.kinds[self.pos][0] is Identifier:
+            self.pos += 1
 
             # Read a list of arguments
-            self.match_value(Punctuator, "(")
-            self.__expression_list()
-            self.match_value(Punctuator, ")")
+            if self.kinds[self.pos] == (Punctuator, "("):
+                self.pos += 1
+                self.__expression_list()
+                if self.kinds[self.pos] == (Punctuator, ")"):
+                    self.pos += 1
 
-            # Any function call that still exists after substitution
-            # evaluates to false
-            return np.int64(0)
-        except ParseError:
-            self.pos = initial_pos
-            raise ParseError("Invalid function call.")
+                    # Any function call that still exists after
+                    # substitution evaluates to false
+                    return np.int64(0)
+
+        self.pos = initial_pos
+        raise ParseError("Invalid function call.")
 
     def term(self):
         """
@@ -2105,122 +2532,103 @@ class ExpressionEvaluator(Parser):
         <term> := [<integer-constant>|<character-constant>|<call>|
                    <identifier>]
         """
-        initial_pos = self.pos
+        (kind, spelling) = self.kinds[self.pos]
 
         # Match an integer constant.
         # Convert from C-style literals to Python integers.
-        try:
-            constant = self.match_type(NumericalConstant)
-
-            # Use prefix (if present) to determine base
-            base = 10
-            bases = {"0x": 16, "0X": 16, "0b": 2, "0B": 2}
+        if kind is NumericalConstant:
+            self.pos += 1
             try:
-                prefix = constant.token[0:2]
-                base = bases[prefix]
-                value = constant.token[2:]
+                return ExpressionEvaluator._constant_cache[spelling]
             except KeyError:
-                value = constant.token
+                pass
+
+            # Use prefix (if present) to determine base
+            base = ExpressionEvaluator._bases.get(spelling[0:2])
+            if base is None:
+                base = 10
+                value = spelling
+            else:
+                value = spelling[2:]
 
             # Strip suffix (if present)
             suffix = None
-            suffixes = [
-                "ull",
-                "ULL",
-                "ul",
-                "UL",
-                "ll",
-                "LL",
-                "u",
-                "U",
-                "l",
-                "L",
-            ]
-            for s in suffixes:
-                if value.endswith(s):
-                    suffix = s
-                    value = value[: -len(s)]
-                    break
+            m = ExpressionEvaluator._suffix_pattern.search(value)
+            if m:
+                suffix = m.group()
+                value = value[: m.start()]
 
             # Convert to decimal and then to integer with correct sign
             # Preprocessor always uses 64-bit arithmetic!
             int_value = int(value, base)
             if suffix and "u" in suffix:
-                return np.uint64(int_value)
+                constant = np.uint64(int_value)
             else:
-                return np.int64(int_value)
-        except ParseError:
-            self.pos = initial_pos
+                constant = np.int64(int_value)
+            ExpressionEvaluator._constant_cache[spelling] = constant
+            return constant
 
         # Match a character constant.
         # Convert from character literals to integer value.
-        try:
-            constant = self.match_type(CharacterConstant)
-            return np.int64(ord(constant.token))
-        except ParseError:
-            self.pos = initial_pos
+        if kind is CharacterConstant:
+            self.pos += 1
+            return np.int64(ord(spelling))
 
-        # Match a function call.
-        try:
-            return self.call()
-        except ParseError:
-            self.pos = initial_pos
+        if kind is Identifier:
+            # Match a function call.
+            # Only identifiers followed by '(' can be calls; anything else
+            # is matched as an identifier without attempting a call.
+            if self.kinds[self.pos + 1] == (Punctuator, "("):
+                try:
+                    return self.call()
+                except ParseError:
+                    pass
 
-        # Match an identifier.
-        # Any identifier that still exists after substitution evaluates
-        # to false
-        try:
-            self.match_type(Identifier)
+            # Match an identifier.
+            # Any identifier that still exists after substitution evaluates
+            # to false
+            self.pos += 1
             return np.int64(0)
-        except ParseError:
-            self.pos = initial_pos
 
         raise ParseError(
             "Expected integer constant, character constant, identifier or "
             + "function call.",
         )
 
-    def primary(self):
-        """
-        Match a simple expression
-        <primary> := [<unary-op><expression>|'('<expression>')'|<term>]
-        """
-        initial_pos = self.pos
-
-        # Match <unary-op><expression>
-        try:
-            operator = self.match_type(Operator)
-            if operator.token in ExpressionEvaluator.UnaryOperators:
-                (prec, assoc) = ExpressionEvaluator.UnaryOperators[
-                    operator.token
-                ]
-            else:
-                raise ParseError("Not a UnaryOperator")
-            expr = self.expression(prec)
-            return self.__apply_unary_op(operator.token, expr)
-        except ParseError:
-            self.pos = initial_pos
-
-        # Match '('<expression>')'
-        try:
-            self.match_value(Punctuator, "(")
-            expr = self.expression()
-            self.match_value(Punctuator, ")")
-            return expr
-        except ParseError:
-            self.pos = initial_pos
-
-        # Match <term>
-        try:
-            term = self.term()
-            return term
-        except ParseError:
-            self.pos = initial_pos
-
-        raise ParseError(
-            "Expected unary expression, expression in parens, or "
-            + "identifier/constant.",
-        )
+    def __reduce(self, operands, operators, dead):
+        """
+        Apply the operator on top of the operator stack to the operands on
+        top of the operand stack, replacing them with the result.
+
+        Operators above the position ``dead`` on the operator stack are
+        in the unevaluated operand of a short-circuiting && or ||, so
+        they are not applied.
+        Return the position of the short-circuiting operator, or None
+        once it has been applied.
+        """
+        (op, _, _, arity) = operators.pop()
+        if dead is not None and len(operators) > dead:
+            del operands[-arity:]
+            operands.append(None)
+            return dead
+
+        if arity == 1:
+            operand = operands.pop()
+            operands.append(self.__apply_unary_op(op, operand))
+        elif arity == 2:
+            rhs = operands.pop()
+            lhs = operands.pop()
+            operands.append(self.__apply_binary_op(op, lhs, rhs))
+        else:
+            # Converting C ternary to Python requires us to swap
+            # expression order:
+            # - C:      (condition) ? true_result : false_result
+            # - Python: true_result if (condition) else false_result
+            false_result = operands.pop()
+            true_result = operands.pop()
+            condition = operands.pop()
+            operands.append(true_result if condition else false_result)
+        return None
 
     def expression(self, min_precedence=0):
         """
@@ -2229,51 +2637,135 @@ class ExpressionEvaluator(Parser):
         climbing.
 
         <expression> := <primary>[<binary-op><expression>]?
+        <primary>    := [<unary-op><primary>|'('<expression>')'|<term>]
+
+        Operands and operators are held on explicit stacks, so that
+        parsing an expression does not require recursion except to parse
+        the arguments of a function call.
         """
-        expr = self.primary()
+        get_binary_operator = ExpressionEvaluator.BinaryOperators.get
+        get_unary_operator = ExpressionEvaluator.UnaryOperators.get
+        kinds = self.kinds
 
-        # Recursion is terminated based on operator precedence
-        while (
-            not self.eol()
-            and (self.cursor().token in ExpressionEvaluator.BinaryOperators)
-            and (
-                ExpressionEvaluator.BinaryOperators[self.cursor().token].prec
-                >= min_precedence
-            )
-        ):
-            operator = self.match_type(Operator)
-            (prec, assoc) = ExpressionEvaluator.BinaryOperators[operator.token]
-
-            # The ternary conditional operator is treated as a
-            # special-case of a binary operator:
-            # lhs "?"<expression>":" rhs
-            if operator.token == "?":
-                true_result = self.expression()
-                self.match_value(Operator, ":")
-
-            # Minimum precedence for right-hand side depends on
-            # associativity
-            if assoc == "LEFT":
-                rhs = self.expression(prec + 1)
-            elif assoc == "RIGHT":
-                rhs = self.expression(prec)
-            else:
-                raise ValueError(
-                    "Encountered a BinaryOperator with no associativity.",
-                )
+        # Operators are stored as (op, prec, assoc, arity) tuples.
+        # Parentheses and ternary conditions have an arity of 0 and the
+        # lowest precedence, so they are never applied as operators.
+        operands = []
+        operators = []
 
-            # Converting C ternary to Python requires us to swap
-            # expression order:
-            # - C:      (condition) ? true_result : false_result
-            # - Python: true_result if (condition) else false_result
-            if operator.token == "?":
-                condition = expr
-                false_result = rhs
-                expr = true_result if condition else false_result
-            else:
-                expr = self.__apply_binary_op(operator.token, expr, rhs)
+        # The number of unmatched '(' and '?' on the operator stack, and
+        # the number of unmatched '(' alone.
+        nesting = 0
+        parens = 0
 
-        return expr
+        # The position of the outermost primary expression being matched.
+        restart = None
+
+        # The position on the operator stack of a && or || whose result
+        # is already known from its left operand.
+        dead = None
+
+        try:
+            while True:
+                # Match any number of <unary-op> and '(', followed by a <term>
+                if parens == 0:
+                    restart = self.pos
+                while True:
+                    (kind, spelling) = kinds[self.pos]
+                    info = get_unary_operator(spelling)
+                    if info is not None and kind is Operator:
+                        operators.append((spelling, *info, 1))
+                    elif kind is Punctuator and spelling == "(":
+                        operators.append(("(", 0, None, 0))
+                        nesting += 1
+                        parens += 1
+                    else:
+                        break
+                    self.pos += 1
+                operands.append(self.term())
+
+                # Match any number of ')' closing a nested expression
+                while nesting > 0 and kinds[self.pos] == (Punctuator, ")"):
+                    while operators[-1][3] != 0:
+                        dead = self.__reduce(operands, operators, dead)
+                    if operators[-1][0] != "(":
+                        raise ParseError("Expected ':'.")
+                    operators.pop()
+                    nesting -= 1
+                    parens -= 1
+                    self.pos += 1
+                if parens == 0:
+                    restart = None
+
+                # The sentinel at the end of the list is handled below.
+                (kind, spelling) = kinds[self.pos]
+
+                # Match a <binary-op>.
+                # Operators already on the stack that bind more tightly
+                # than this operator are applied first, depending on
+                # associativity.
+                info = get_binary_operator(spelling)
+                if info is not None:
+                    if kind is not Operator:
+                        raise ParseError(f"Expected {Operator!s}.")
+                    (prec, assoc) = info
+                    if prec < min_precedence and nesting == 0:
+                        break
+                    while operators and (
+                        operators[-1][1] > prec
+                        or (operators[-1][1] == prec and assoc == "LEFT")
+                    ):
+                        dead = self.__reduce(operands, operators, dead)
+                    self.pos += 1
+
+                    # The ternary conditional operator is treated as a
+                    # special-case of a binary operator:
+                    # lhs "?"<expression>":" rhs
+                    if spelling == "?":
+                        operators.append(("?", 0, None, 0))
+                        nesting += 1
+                    else:
+                        # Skip evaluation of the right operand of && or ||
+                        # if the left operand determines the result.
+                        if dead is None and (
+                            (spelling == "&&" and not operands[-1])
+                            or (spelling == "||" and operands[-1])
+                        ):
+                            dead = len(operators)
+                        operators.append((spelling, prec, assoc, 2))
+
+                # Match the ':' of a ternary conditional operator, which
+                # closes the nested expression for its true result.
+                elif nesting > 0 and kind is Operator and spelling == ":":
+                    while operators[-1][3] != 0:
+                        dead = self.__reduce(operands, operators, dead)
+                    if operators[-1][0] != "?":
+                        raise ParseError("Expected ')'.")
+                    operators.pop()
+                    nesting -= 1
+                    self.pos += 1
+                    operators.append(("?", *get_binary_operator("?"), 3))
+
+                # Nested expressions must be closed.
+                elif nesting > 0:
+                    raise ParseError("Expected ')' or ':'.")
+
+                # Anything else terminates the expression.
+                else:
+                    break
+
+            if nesting > 0:
+                raise ParseError("Expected ')' or ':'.")
+        except ParseError:
+            # Matching failed within a primary expression, so rewind to
+            # the start of the outermost primary expression.
+            if restart is not None:
+                self.pos = restart
+            raise
+
+        while operators:
+            dead = self.__reduce(operands, operators, dead)
+        return operands[-1]
 
     def __expression_list(self):
         """
@@ -2283,31 +2775,29 @@ class ExpressionEvaluator(Parser):
         <expression-list> := [<expression>][','<expression-list>]*
         """
         exprs = []
-        try:
-            expr = self.expression()
-            exprs.append(expr)
 
-            while True:
-                self.match_value(Punctuator, ",")
-                expr = self.expression()
-                exprs.append(expr)
-        except ParseError:
+        # An empty list is common (e.g. "f()"), so check for it first.
+        # The sentinel at the end of the token list has no spelling.
+        if self.kinds[self.pos][1] in (None, ")"):
             return exprs
 
+        try:
+            exprs.append(self.expression())
+            while self.kinds[self.pos] == (Punctuator, ","):
+                self.pos += 1
+                exprs.append(self.expression())
+        except ParseError:
+            pass
+        return exprs
+
     @staticmethod
     def __apply_unary_op(op, operand):
         """
         Apply the specified unary operator: op operand
         """
-        if op == "-":
-            return -operand
-        elif op == "+":
-            return +operand
-        elif op == "!":
-            return not operand
-        elif op == "~":
-            return ~operand
-        else:
+        try:
+            return ExpressionEvaluator._unary_functions[op](operand)
+        except KeyError:
             raise ValueError("Not a valid unary operator.")
 
     @staticmethod
@@ -2315,43 +2805,9 @@ class ExpressionEvaluator(Parser):
         """
         Apply the specified binary operator: lhs op rhs
         """
-        if op == "||":
-            return lhs or rhs
-        elif op == "&&":
-            return lhs and rhs
-        elif op == "|":
-            return lhs | rhs
-        elif op == "^":
-            return lhs ^ rhs
-        elif op == "&":
-            return lhs & rhs
-        elif op == "==":
-            return lhs == rhs
-        elif op == "!=":
-            return lhs != rhs
-        elif op == "<":
-            return lhs < rhs
-        elif op == "<=":
-            return lhs <= rhs
-        elif op == ">":
-            return lhs > rhs
-        elif op == ">=":
-            return lhs >= rhs
-        elif op == "<<":
-            return lhs << rhs
-        elif op == ">>":
-            return lhs >> rhs
-        elif op == "+":
-            return lhs + rhs
-        elif op == "-":
-            return lhs - rhs
-        elif op == "*":
-            return lhs * rhs
-        elif op == "/":
-            return lhs // rhs  # force integer division
-        elif op == "%":
-            return lhs % rhs
-        else:
+        try:
+            return ExpressionEvaluator._binary_functions[op](lhs, rhs)
+        except KeyError:
             raise ValueError("Not a binary operator.")
 
     def evaluate(self):
@@ -2359,23 +2815,41 @@ class ExpressionEvaluator(Parser):
         Evaluate a preprocessor expression.
         Return True/False or raises an exception if the expression is
         not recognized.
+
+        The result depends only on the type and spelling of each token,
+        so results are cached and shared by all evaluators.
         """
+        key = tuple(self.kinds)
+        try:
+            return ExpressionEvaluator._evaluate_cache[key]
+        except KeyError:
+            pass
+
         try:
             test_val = self.expression()
-            return test_val != 0
+            result = test_val != 0
         except ValueError:
             raise ParseError("Could not evaluate expression.")
 
+        ExpressionEvaluator._evaluate_cache[key] = result
+        return result
+
 
 class SourceTree:
     """
     Represents a source file as a tree of directive and code nodes.
     """
 
+    __slots__ = ("root", "_latest_node", "_open_blocks")
+
     def __init__(self, filename):
         self.root = FileNode(filename)
         self._latest_node = self.root
 
+        # The tree start or continue node of each open tree, innermost
+        # last.
+        self._open_blocks = []
+
     def walk(self) -> Iterable[Node]:
         """
         Returns
@@ -2409,21 +2883,26 @@ class SourceTree:
         or a tree continue node.
         """
 
-        while not (
-            self._latest_node.is_start_node()
-            or self._latest_node.is_cont_node()
-        ):
-            self._latest_node = self._latest_node.parent
-            if self._latest_node == self.root:
-                log.error(
-                    "Found root while trying to find an insertion point.",
-                )
-                break
+        if self._open_blocks:
+            self._latest_node = self._open_blocks[-1]
+        else:
+            self._latest_node = self.root
+            log.error("Found root while trying to find an insertion point.")
 
     def __insert_in_place(self, new_node, parent):
         parent.add_child(new_node)
         self._latest_node = new_node
 
+        if new_node._is_start:
+            self._open_blocks.append(new_node)
+        elif new_node._is_cont:
+            if self._open_blocks:
+                self._open_blocks[-1] = new_node
+            else:
+                self._open_blocks.append(new_node)
+        elif new_node._is_end and self._open_blocks:
+            self._open_blocks.pop()
+
     def insert(self, new_node):
         """
         Handle the logic of proper node insertion.
@@ -2436,18 +2915,15 @@ class SourceTree:
         # Tree start nodes should be inserted as siblings of the
         # previous node, unless it was a tree start, or tree continue
         # node. In which case it's a child.
-        elif new_node.is_start_node():
-            if (
-                self._latest_node.is_start_node()
-                or self._latest_node.is_cont_node()
-            ):
+        elif new_node._is_start:
+            if self._latest_node._is_start or self._latest_node._is_cont:
                 self.__insert_in_place(new_node, self._latest_node)
             else:
                 self.__insert_in_place(new_node, self._latest_node.parent)
 
         # If the node is a tree continue or a tree end node, it must be
         # added as a sibling of a valid / active tree node.
-        elif new_node.is_cont_node() or new_node.is_end_node():
+        elif new_node._is_cont or new_node._is_end:
             # Need to walk back to find the previous level where an else
             # or an end can be added
             self.walk_to_tree_insertion_point()
@@ -2457,10 +2933,7 @@ class SourceTree:
         # Otherwise, if the previous node was a tree start or a tree
         # continue, the new node is a child. If not, it's a sibling.
         else:
-            if (
-                self._latest_node.is_start_node()
-                or self._latest_node.is_cont_node()
-            ):
+            if self._latest_node._is_start or self._latest_node._is_cont:
                 self.__insert_in_place(new_node, self._latest_node)
             else:
                 self.__insert_in_place(new_node, self._latest_node.parent)
@@ -4,9 +4,9 @@
 Contains functions for generating command-line reports.
 """
 
+import contextlib
 import filecmp
 import hashlib
-import itertools as it
 import logging
 import numbers
 import os
@@ -14,11 +14,13 @@ import re
 import string
 import sys
 import warnings
-from collections import defaultdict
+from collections import Counter, defaultdict
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Self, TextIO
 
+import numpy as np
 from tabulate import tabulate
 
 from codebasin import CodeBase, util
@@ -32,8 +34,46 @@ def extract_platforms(setmap):
     """
     Extract a list of unique platforms from a set map
     """
-    unique_platforms = set(it.chain.from_iterable(setmap.keys()))
-    return list(unique_platforms)
+    return list(set().union(*setmap.keys()))
+
+
+def _membership(setmap, platforms):
+    """
+    Return a platforms x platform-sets matrix recording which platform sets
+    contain each platform, and an array of the counts for each platform set.
+    """
+    # Empty platform sets and sets without any lines cannot contribute to
+    # the distance between any pair of platforms.
+    items = [(pset, count) for pset, count in setmap.items() if pset and count]
+    counts = np.fromiter(
+        (count for _, count in items),
+        dtype=np.int64,
+        count=len(items),
+    )
+
+    # Visit only the platforms that each set contains, rather than testing
+    # every platform against every set.
+    index = {p: i for i, p in enumerate(platforms)}
+    membership = np.zeros((len(platforms), len(items)), dtype=bool)
+    for column, (pset, _) in enumerate(items):
+        for p in pset:
+            row = index.get(p)
+            if row is not None:
+                membership[row, column] = True
+    return membership, counts
+
+
+def _distance_matrix(membership, counts):
+    """
+    Compute the distance between every pair of platforms in a membership
+    matrix produced by _membership.
+    """
+    # The lines shared by each pair of platforms form a weighted Gram
+    # matrix, from which the union and symmetric difference follow.
+    shared = (membership * counts) @ membership.T.astype(np.int64)
+    used = np.diag(shared)
+    totals = used[:, None] + used[None, :] - shared
+    return (totals - shared) / np.where(totals == 0, 1, totals)
 
 
 def distance(setmap, p1, p2):
@@ -41,14 +81,17 @@ def distance(setmap, p1, p2):
     Compute distance between two platforms
     """
     total = 0
-    for pset, count in setmap.items():
-        if (p1 in pset) or (p2 in pset):
-            total += count
     d = 0
     for pset, count in setmap.items():
-        if (p1 in pset) ^ (p2 in pset):
-            d += count / float(total)
-    return d
+        in_p1 = p1 in pset
+        in_p2 = p2 in pset
+        if in_p1 or in_p2:
+            total += count
+            if in_p1 != in_p2:
+                d += count
+    if total == 0:
+        return 0.0
+    return d / float(total)
 
 
 def divergence(setmap):
@@ -57,16 +100,19 @@ def divergence(setmap):
     i.e. average of pair-wise distances between platform sets
     """
     platforms = extract_platforms(setmap)
+    membership, counts = _membership(setmap, platforms)
+    matrix = _distance_matrix(membership, counts)
+    return _average_distance(matrix)
 
-    d = 0
-    npairs = 0
-    for p1, p2 in it.combinations(platforms, 2):
-        d += distance(setmap, p1, p2)
-        npairs += 1
 
-    if npairs == 0:
+def _average_distance(matrix):
+    """
+    Compute the average of the pair-wise distances in a distance matrix.
+    """
+    pairs = matrix[np.triu_indices(len(matrix), 1)]
+    if pairs.size == 0:
         return float("nan")
-    return d / float(npairs)
+    return float(pairs.mean())
 
 
 def utilization(setmap: defaultdict[frozenset[str], int]) -> float:
@@ -202,9 +248,8 @@ def clustering(output_name, setmap):
     from scipy.spatial.distance import squareform
 
     # Compute distance matrix between platforms
-    matrix = [
-        [distance(setmap, p1, p2) for p2 in platforms] for p1 in platforms
-    ]
+    membership, counts = _membership(setmap, platforms)
+    matrix = _distance_matrix(membership, counts)
 
     # Print distance matrix as a table
     lines = []
@@ -223,7 +268,10 @@ def clustering(output_name, setmap):
     ]
 
     # Hierarchical clustering using average inter-cluster distance
-    clusters = hierarchy.linkage(squareform(matrix), method="average")
+    clusters = hierarchy.linkage(
+        squareform(matrix, checks=False),
+        method="average",
+    )
 
     # Plot dendrogram of hierarchical clustering
     # Ignore SciPy warning about axis limits, because we override them
@@ -231,9 +279,10 @@ def clustering(output_name, setmap):
     with warnings.catch_warnings(action="ignore"):
         hierarchy.dendrogram(clusters, labels=platforms, orientation="right")
     ax.set_xlim(xmin=0, xmax=1)
-    ax.axvline(x=divergence(setmap), linestyle="--", label="Average")
+    cd = _average_distance(matrix)
+    ax.axvline(x=cd, linestyle="--", label="Average")
     ax.text(
-        divergence(setmap),
+        cd,
         ax.get_ylim()[1],
         "Average",
         ha="center",
@@ -246,6 +295,91 @@ def clustering(output_name, setmap):
     return "\n".join(lines)
 
 
+def _file_digest(path: Path) -> bytes:
+    """
+    Return a digest of the contents of the file at `path`.
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").digest()
+
+
+def _partition_files(paths: list[Path]) -> list[set[Path]]:
+    """
+    Partition files of the same size by their contents, reading every file
+    once and all files in lockstep. Opens all of the files at once.
+
+    Returns
+    -------
+    list[set[Path]]
+        A list of sets of Paths with identical contents, including sets
+        containing a single Path.
+    """
+    block_size = 65536
+    with contextlib.ExitStack() as stack:
+        files = {path: stack.enter_context(open(path, "rb")) for path in paths}
+
+        # Split each group of candidates whenever their blocks differ.
+        # Files are the same size, so a group reaches the end together.
+        classes = []
+        groups = [paths]
+        while groups:
+            refined = []
+            for group in groups:
+                by_block = defaultdict(list)
+                for path in group:
+                    by_block[files[path].read(block_size)].append(path)
+                for block, matches in by_block.items():
+                    if block and len(matches) > 1:
+                        refined.append(matches)
+                    else:
+                        classes.append(set(matches))
+            groups = refined
+    return classes
+
+
+def _identical_files(
+    paths: set[Path],
+    max_open: int = 256,
+) -> list[set[Path]]:
+    """
+    Partition files of the same size by their contents.
+
+    Parameters
+    ----------
+    paths: set[Path]
+        The files to compare, which must all be the same size.
+
+    max_open: int, default: 256
+        The maximum number of files to hold open at once.
+
+    Returns
+    -------
+    list[set[Path]]
+        A list of all sets of (two or more) Paths with identical contents.
+    """
+    paths = list(paths)
+    if len(paths) <= max_open:
+        classes = _partition_files(paths)
+        return [matches for matches in classes if len(matches) > 1]
+
+    # Compare the files in chunks that can all be open at once.
+    classes = []
+    for start in range(0, len(paths), max_open):
+        classes.extend(_partition_files(paths[start : start + max_open]))
+
+    # Merge classes from different chunks by comparing one file from each.
+    merged = []
+    for matches in classes:
+        first = next(iter(matches))
+        for other in merged:
+            if filecmp.cmp(first, next(iter(other)), shallow=False):
+                other.update(matches)
+                break
+        else:
+            merged.append(matches)
+    return [matches for matches in merged if len(matches) > 1]
+
+
 def find_duplicates(codebase: CodeBase) -> list[set[Path]]:
     """
     Search for duplicate files in the code base.
@@ -255,37 +389,39 @@ def find_duplicates(codebase: CodeBase) -> list[set[Path]]:
     list[set[Path]]
         A list of all sets of Paths with identical contents.
     """
-    # Search for possible matches using a hash, ignoring symlinks.
-    possible_matches = {}
+    # Search for possible matches using the file size, ignoring symlinks.
+    sizes = {}
     for path in codebase:
         path = Path(path)
         if path.is_symlink():
             continue
-        with open(path, "rb") as f:
-            digest = hashlib.file_digest(f, "sha512").hexdigest()
-        if digest not in possible_matches:
-            possible_matches[digest] = set()
-        possible_matches[digest].add(path)
+        sizes[path] = path.stat().st_size
+    size_counts = Counter(sizes.values())
+
+    # Refine possible matches using a hash, skipping files with unique sizes.
+    # The hash only groups candidates, so BLAKE2 is used for its speed.
+    # Files are hashed in parallel, since hashlib releases the GIL.
+    # Candidates keep the order of the code base, so that matches are
+    # reported in the order in which they are first seen.
+    candidates = [
+        (size, path) for path, size in sizes.items() if size_counts[size] > 1
+    ]
+    with ThreadPoolExecutor() as executor:
+        digests = executor.map(_file_digest, (path for _, path in candidates))
+        possible_matches = {}
+        for (size, path), digest in zip(candidates, digests):
+            key = (size, digest)
+            if key not in possible_matches:
+                possible_matches[key] = set()
+            possible_matches[key].add(path)
 
     # Confirm equality for files with the same hash.
     confirmed_matches = []
-    for digest, path_set in possible_matches.items():
+    for path_set in possible_matches.values():
         # Skip files with no hash conflicts.
         if len(path_set) == 1:
             continue
-
-        # Check for equality amongst all files in the set.
-        # Iterate until we have identified all conflicting hashes.
-        remaining = path_set.copy()
-        while len(remaining) > 1:
-            first = remaining.pop()
-            matches = {first}
-            for path in remaining:
-                if filecmp.cmp(first, path, shallow=False):
-                    matches.add(path)
-            remaining.difference_update(matches)
-            if len(matches) > 1:
-                confirmed_matches.append(matches)
+        confirmed_matches.extend(_identical_files(path_set))
 
     return confirmed_matches
 
@@ -349,6 +485,9 @@ def _human_readable(x: int) -> str:
     return "******"
 
 
+_color_pattern = re.compile(r"\033\[[0-9]*m")
+
+
 def _strip_colors(s: str) -> str:
     """
     Strip ASCII color codes from a string.
@@ -371,7 +510,7 @@ def _strip_colors(s: str) -> str:
     if not isinstance(s, str):
         raise TypeError("s must be a string")
 
-    return re.sub(r"\033\[[0-9]*m", "", s)
+    return _color_pattern.sub("", s)
 
 
 class FileTree:
@@ -399,6 +538,15 @@ class FileTree:
             self.children = {}
             self.is_root = is_root
 
+            # Derived from the setmap, which only changes via _update().
+            self._platforms = None
+            self._sloc = None
+            self._total_sloc = None
+
+            # Filesystem attributes are looked up once, on first use.
+            self._is_dir = None
+            self._is_symlink = None
+
         @property
         def name(self):
             if self.is_root:
@@ -407,22 +555,62 @@ class FileTree:
 
         @property
         def platforms(self):
-            return extract_platforms(self.setmap)
+            # Return a copy, so that callers cannot modify the cached set.
+            return list(self._platform_set())
+
+        def _platform_set(self) -> frozenset[str]:
+            """
+            Returns
+            -------
+            frozenset[str]
+                The platforms used by this Node, cached until the next
+                _update().
+            """
+            if self._platforms is None:
+                self._platforms = frozenset(extract_platforms(self.setmap))
+            return self._platforms
 
         @property
         def sloc(self):
-            count = 0
-            for k, v in self.setmap.items():
-                if len(k) == 0:
-                    continue
-                count += v
-            return count
+            if self._sloc is None:
+                count = 0
+                for k, v in self.setmap.items():
+                    if len(k) == 0:
+                        continue
+                    count += v
+                self._sloc = count
+            return self._sloc
+
+        @property
+        def total_sloc(self):
+            if self._total_sloc is None:
+                self._total_sloc = sum(self.setmap.values())
+            return self._total_sloc
+
+        def _update(self, setmap):
+            """
+            Add the SLOC counts from another setmap to this Node.
+
+            Parameters
+            ----------
+            setmap: defaultdict[str, int]
+                The setmap to add to this Node's setmap.
+            """
+            for ps, count in setmap.items():
+                self.setmap[ps] += count
+            self._platforms = None
+            self._sloc = None
+            self._total_sloc = None
 
         def is_dir(self):
-            return self.path.is_dir()
+            if self._is_dir is None:
+                self._is_dir = self.path.is_dir()
+            return self._is_dir
 
         def is_symlink(self):
-            return self.path.is_symlink()
+            if self._is_symlink is None:
+                self._is_symlink = self.path.is_symlink()
+            return self._is_symlink
 
         def _platforms_str(
             self,
@@ -443,9 +631,10 @@ class FileTree:
             str
                 A string representing the platforms used by this Node.
             """
+            platforms = self._platform_set()
             output = ""
             for i, platform in enumerate(sorted(all_platforms)):
-                if platform in self.platforms:
+                if platform in platforms:
                     if self.is_symlink():
                         color = "\033[96m"
                     else:
@@ -474,7 +663,7 @@ class FileTree:
                 "used / total" with human-readable numbers.
             """
             color = ""
-            if len(self.platforms) == 0:
+            if len(self._platform_set()) == 0:
                 color = "\033[2m"
             elif self.is_symlink():
                 color = "\033[96m"
@@ -483,7 +672,7 @@ class FileTree:
             total_len = len(_human_readable(max_total))
 
             used = _human_readable(self.sloc)
-            total = _human_readable(sum(self.setmap.values()))
+            total = _human_readable(self.total_sloc)
 
             return f"{color}{used:>{used_len}} / {total:>{total_len}}\033[0m"
 
@@ -496,13 +685,13 @@ class FileTree:
             """
             cd = divergence(self.setmap)
             color = ""
-            if len(self.platforms) == 0:
+            if len(self._platform_set()) == 0:
                 color = "\033[2m"
             elif self.is_symlink():
                 color = "\033[96m"
             elif cd <= 0.25:
                 color = "\033[32m"
-            elif cd >= 0.75 or len(self.platforms) == 1:
+            elif cd >= 0.75 or len(self._platform_set()) == 1:
                 color = "\033[35m"
             return f"{color}{cd:4.2f}\033[0m"
 
@@ -521,7 +710,7 @@ class FileTree:
             nu = normalized_utilization(self.setmap, total_platforms)
 
             color = ""
-            if len(self.platforms) == 0:
+            if len(self._platform_set()) == 0:
                 color = "\033[2m"
             elif self.is_symlink():
                 color = "\033[96m"
@@ -544,13 +733,12 @@ class FileTree:
             str
                 A string representing meta-information for this FileTree.Node.
             """
-            max_used = root.sloc
-            max_total = sum(root.setmap.values())
+            all_platforms = root._platform_set()
             info = [
-                self._platforms_str(root.platforms),
-                self._sloc_str(max_used, max_total),
+                self._platforms_str(all_platforms),
+                self._sloc_str(root.sloc, root.total_sloc),
                 self._divergence_str(),
-                self._utilization_str(len(root.platforms)),
+                self._utilization_str(len(all_platforms)),
             ]
             return "[" + " | ".join(info) + "]"
 
@@ -573,31 +761,32 @@ class FileTree:
         setmap: dict | None
             The setmap information associated with this filename.
         """
-        rootpath = self.root.path
         filepath = Path(filename)
 
-        parent = self.root
-        for path in list(reversed(filepath.parents)) + [filepath]:
-            # Do not create nodes above the chosen root directory.
-            if path == rootpath or not path.is_relative_to(rootpath):
-                continue
+        # Do not create nodes above the chosen root directory.
+        if not filepath.is_relative_to(self.root.path):
+            return
+        parts = filepath.relative_to(self.root.path).parts
 
-            # Do not propagate information from symlinks.
-            if not filepath.is_symlink():
-                for ps in setmap.keys():
-                    parent.setmap[ps] += setmap[ps]
+        # Do not propagate information from symlinks.
+        propagate = not filepath.is_symlink()
+
+        parent = self.root
+        for name in parts:
+            if propagate:
+                parent._update(setmap)
 
             # If this name exists, find the node.
-            if parent is not None and path.name in parent.children:
-                node = parent.children[path.name]
+            node = parent.children.get(name)
 
             # Otherwise, create the node.
-            else:
+            if node is None:
+                path = parent.path / name
                 if not path.is_dir():
                     node = FileTree.Node(path, setmap)
                 else:
                     node = FileTree.Node(path)
-                parent.children[path.name] = node
+                parent.children[name] = node
 
             parent = node
 
@@ -607,7 +796,8 @@ class FileTree:
         prefix: str = "",
         connector: str = "",
         fancy: bool = True,
-    ):
+        lines: list[str] | None = None,
+    ) -> list[str]:
         """
         Recursive helper function to print all nodes in a FileTree.
 
@@ -624,6 +814,15 @@ class FileTree:
 
         fancy: bool, default: True
             Whether to use fancy formatting (including colors).
+
+        lines: list[str], optional
+            The list to append lines to, shared by all recursive calls.
+            By default, a new list is created.
+
+        Returns
+        -------
+        list[str]
+            The list of lines, with one line for each node printed.
         """
         if fancy:
             dash = "\u2500"
@@ -636,7 +835,8 @@ class FileTree:
             last = "\\"
             vert = "|"
 
-        lines = []
+        if lines is None:
+            lines = []
 
         name = ""
         if node.is_dir():
@@ -659,7 +859,7 @@ class FileTree:
         # Print this node.
         stub = "" if node == self.root else dash
         stub += "o" if node.is_dir() else dash
-        lines += [f"{meta} {prefix}{connector}{stub} {name}"]
+        lines.append(f"{meta} {prefix}{connector}{stub} {name}")
 
         # Prefix children with spaces or vertical line, depending on position.
         if connector == "":
@@ -669,17 +869,19 @@ class FileTree:
         else:
             next_prefix = prefix + vert + " "
 
-        for i, name in enumerate(node.children):
+        last_index = len(node.children) - 1
+        for i, child in enumerate(node.children.values()):
             # Use a different connector for the last child in each directory.
-            if i == len(node.children) - 1:
+            if i == last_index:
                 next_connector = last
             else:
                 next_connector = cont
-            lines += self._print(
-                node.children[name],
+            self._print(
+                child,
                 next_prefix,
                 next_connector,
                 fancy,
+                lines,
             )
 
         return lines
@@ -8,7 +8,7 @@ import unittest
 from pathlib import Path
 
 from codebasin import CodeBase, finder
-from codebasin.report import find_duplicates
+from codebasin.report import _identical_files, find_duplicates
 
 
 class TestDuplicates(unittest.TestCase):
@@ -134,6 +134,48 @@ class TestDuplicates(unittest.TestCase):
 
         tmp.cleanup()
 
+    def test_find_duplicates_same_size(self):
+        """Check that files of the same size are not assumed identical."""
+        tmp = tempfile.TemporaryDirectory()
+        path = Path(tmp.name)
+        with open(path / "foo.cpp", mode="w") as f:
+            f.write("void foo();")
+        with open(path / "bar.cpp", mode="w") as f:
+            f.write("void bar();")
+        with open(path / "baz.cpp", mode="w") as f:
+            f.write("void foo();")
+        codebase = CodeBase(path)
+
+        duplicates = find_duplicates(codebase)
+        expected_duplicates = [{path / "foo.cpp", path / "baz.cpp"}]
+        self.assertCountEqual(duplicates, expected_duplicates)
+
+        tmp.cleanup()
+
+    def test_identical_files(self):
+        """Check that large files and large sets of files are compared."""
+        tmp = tempfile.TemporaryDirectory()
+        path = Path(tmp.name)
+        contents = {
+            "a": b"x" * 200000,
+            "b": b"x" * 199999 + b"y",
+            "c": b"x" * 200000,
+            "d": b"x" * 199999 + b"y",
+            "e": b"x" * 100000 + b"y" + b"x" * 99999,
+        }
+        for name, data in contents.items():
+            with open(path / name, mode="wb") as f:
+                f.write(data)
+        paths = {path / name for name in contents}
+
+        expected = [{path / "a", path / "c"}, {path / "b", path / "d"}]
+        for max_open in [2, 3, 256]:
+            with self.subTest(max_open=max_open):
+                identical = _identical_files(paths, max_open=max_open)
+                self.assertCountEqual(identical, expected)
+
+        tmp.cleanup()
+
     def test_find_duplicates_symlinks(self):
         """Check that we ignore symlinks when identifying duplicates."""
         tmp = tempfile.TemporaryDirectory()
@@ -43,6 +43,7 @@ class TestFileTreeNode(unittest.TestCase):
         self.assertEqual(node.name, self.path.name)
         self.assertEqual(node.platforms, [])
         self.assertEqual(node.sloc, 0)
+        self.assertEqual(node.total_sloc, 0)
         self.assertTrue(node.is_dir())
         self.assertFalse(node.is_symlink())
 
@@ -58,7 +59,10 @@ class TestFileTreeNode(unittest.TestCase):
         self.assertTrue(node.is_root)
         self.assertEqual(node.name, str(self.path))
         self.assertCountEqual(node.platforms, ["X", "Y"])
+        node.platforms.append("Z")
+        self.assertCountEqual(node.platforms, ["X", "Y"])
         self.assertEqual(node.sloc, 6)
+        self.assertEqual(node.total_sloc, 12)
 
     def test_platforms_str(self):
         """Check platform string format."""
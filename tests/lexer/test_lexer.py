@@ -124,6 +124,36 @@ class TestLexer(unittest.TestCase):
         self.assertTrue(isinstance(tokens[5], preprocessor.Operator))
         self.assertTrue(isinstance(tokens[6], preprocessor.StringConstant))
 
+    def test_escapes(self):
+        """escaped quotes"""
+        tokens = preprocessor.Lexer(r"""'\'' "a\"b" """).tokenize()
+        self.assertTrue(len(tokens) == 2)
+        self.assertTrue(isinstance(tokens[0], preprocessor.CharacterConstant))
+        self.assertTrue(tokens[0].token == r"\'")
+        self.assertTrue(isinstance(tokens[1], preprocessor.StringConstant))
+        self.assertTrue(tokens[1].token == r"a\"b")
+
+        # An escaped quote cannot terminate a string
+        tokens = preprocessor.Lexer(r'"a\"').tokenize()
+        self.assertTrue(
+            [str(t.token) for t in tokens] == ['"', "a", "\\", '"'],
+        )
+
+    def test_whitespace(self):
+        """whitespace"""
+        tokens = preprocessor.Lexer(" a\tb(c ) ").tokenize()
+        self.assertTrue([t.col for t in tokens] == [1, 3, 4, 5, 7])
+        self.assertTrue(
+            [t.prev_white for t in tokens] == [True, True, False, False, True],
+        )
+
+    def test_non_ascii(self):
+        """non-ASCII identifiers"""
+        tokens = preprocessor.Lexer("x + \u00e9t\u00e9").tokenize()
+        self.assertTrue(len(tokens) == 3)
+        self.assertTrue(isinstance(tokens[2], preprocessor.Identifier))
+        self.assertTrue(tokens[2].token == "\u00e9t\u00e9")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -158,6 +158,71 @@ class TestMacroExpansion(unittest.TestCase):
                     expected_expansion[i].token,
                 )
 
+    def test_variadic_cat(self):
+        """variadic arguments that are not pre-expanded"""
+        mac_cat = preprocessor.macro_from_definition_string(
+            "CAT(x, ...)=x ## __VA_ARGS__",
+        )
+        mac_foo = preprocessor.macro_from_definition_string("foo=4")
+        p = platform.Platform("Test", self.rootdir)
+        p._definitions = {x.name: x for x in [mac_cat, mac_foo]}
+
+        tokens = preprocessor.Lexer("CAT(a, foo)").tokenize()
+        expanded_tokens = preprocessor.MacroExpander(p).expand(tokens)
+        expected_tokens = preprocessor.Lexer("afoo").tokenize()
+        self.assertEqual(
+            [x.token for x in expanded_tokens],
+            [x.token for x in expected_tokens],
+        )
+
+    def test_redefined_macros(self):
+        """#if after the macros it uses are redefined"""
+        tokens = preprocessor.Lexer("#if FOO").tokenize()
+        node = preprocessor.DirectiveParser(tokens).parse()
+        p = platform.Platform("Test", self.rootdir)
+
+        definitions = [
+            (["FOO=1"], True),
+            (["FOO=0"], False),
+            (["FOO=BAR", "BAR=1"], True),
+            (["FOO=BAR", "BAR=0"], False),
+            (["FOO=CAT(B, AR)", "CAT(x, y)=x ## y", "BAR=1"], True),
+            (["FOO=CAT(B, AR)", "CAT(x, y)=x ## y", "BAR=0"], False),
+        ]
+        # Reuse macro definitions, so that only the macros named by other
+        # macros differ between some cases.
+        macros = {}
+        for strings, _ in definitions:
+            for s in strings:
+                macros[s] = preprocessor.macro_from_definition_string(s)
+
+        for strings, expected in definitions:
+            p._definitions = {macros[s].name: macros[s] for s in strings}
+            self.assertEqual(node.evaluate_for_platform(platform=p), expected)
+
+    def test_equal_definitions(self):
+        """#if with equal macros defined by different platforms"""
+        tokens = preprocessor.Lexer("#if F(FOO) == 2").tokenize()
+        node = preprocessor.DirectiveParser(tokens).parse()
+        cache = preprocessor.IfNode._evaluate_cache
+
+        # Each platform creates its own Macro objects, but the definitions
+        # are equal, so only the first evaluation adds a cache entry.
+        for name, added in [("A", 1), ("B", 0)]:
+            p = platform.Platform(name, self.rootdir)
+            for s in ["FOO=1", "F(x)=x + 1"]:
+                macro = preprocessor.macro_from_definition_string(s)
+                p.define(macro.name, macro)
+
+            size = len(cache)
+            self.assertTrue(node.evaluate_for_platform(platform=p))
+            self.assertEqual(len(cache), size + added)
+
+            fingerprint = preprocessor._macro_fingerprint(node.tokens, p)
+            self.assertIsNotNone(fingerprint)
+            key = (tuple((type(t), t.token) for t in node.tokens), fingerprint)
+            self.assertIn(key, cache)
+
     def test_self_reference_macros_1(self):
         """Self referencing macros test 1"""
 
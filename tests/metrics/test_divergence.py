@@ -6,7 +6,7 @@ import math
 import unittest
 import warnings
 
-from codebasin.report import divergence
+from codebasin.report import distance, divergence
 
 
 class TestDivergence(unittest.TestCase):
@@ -44,6 +44,22 @@ class TestDivergence(unittest.TestCase):
         }
         self.assertTrue(math.isnan(divergence(setmap)))
 
+    def test_distance(self):
+        """Check distance computation for simple setmap."""
+        setmap = {
+            frozenset(["A"]): 1,
+            frozenset(["B"]): 2,
+            frozenset(["A", "B"]): 3,
+            frozenset(["C"]): 0,
+        }
+        self.assertEqual(distance(setmap, "A", "B"), 0.5)
+        self.assertEqual(distance(setmap, "B", "A"), 0.5)
+        self.assertEqual(distance(setmap, "A", "A"), 0.0)
+        self.assertEqual(distance(setmap, "C", "A"), 1.0)
+
+        # Platforms that share no lines are treated as identical.
+        self.assertEqual(distance(setmap, "C", "D"), 0.0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -57,6 +57,64 @@ class TestOperators(unittest.TestCase):
         p._definitions = {macro.name: macro}
         _ = preprocessor.MacroExpander(p).expand(tokens)
 
+    def test_deep_nesting(self):
+        """deeply nested expressions"""
+        depth = 5000
+        for expr in [
+            "(" * depth + "1" + ")" * depth,
+            "!" * depth + "1",
+            "1 ? " * depth + "1" + " : 0" * depth,
+            "0 | " * depth + "1",
+        ]:
+            tokens = preprocessor.Lexer(expr).tokenize()
+            result = preprocessor.ExpressionEvaluator(tokens).evaluate()
+            self.assertTrue(result)
+
+    def test_short_circuit(self):
+        """unevaluated operands of && and ||"""
+        # Mixing signed and unsigned operands raises if evaluated.
+        invalid = "(1u ^ 1)"
+        for expr, expected in [
+            (f"0 && {invalid}", False),
+            (f"1 || {invalid}", True),
+            (f"0 && {invalid} || 1", True),
+            (f"1 && 0 && {invalid}", False),
+        ]:
+            tokens = preprocessor.Lexer(expr).tokenize()
+            result = preprocessor.ExpressionEvaluator(tokens).evaluate()
+            self.assertEqual(result, expected)
+
+    def test_division_by_zero(self):
+        """division and modulo by zero evaluate to zero"""
+        for op in ["/", "%"]:
+            for lhs, rhs in [
+                ("3", "0"),
+                ("-3", "0"),
+                ("3u", "0u"),
+                ("3u", "0"),
+                ("3", "0u"),
+            ]:
+                for expr, expected in [
+                    (f"{lhs} {op} {rhs}", False),
+                    (f"({lhs} {op} {rhs}) == 0", True),
+                ]:
+                    tokens = preprocessor.Lexer(expr).tokenize()
+                    evaluator = preprocessor.ExpressionEvaluator(tokens)
+                    with self.subTest(expr=expr):
+                        self.assertEqual(evaluator.evaluate(), expected)
+
+    def test_evaluate_cache(self):
+        """cached results and constants are bounded"""
+        cache = preprocessor.ExpressionEvaluator._evaluate_cache
+        for i in range(cache.maxsize + 10):
+            tokens = preprocessor.Lexer(f"{i} == {i}").tokenize()
+            result = preprocessor.ExpressionEvaluator(tokens).evaluate()
+            self.assertTrue(result)
+        self.assertLessEqual(len(cache), cache.maxsize)
+
+        cache = preprocessor.ExpressionEvaluator._constant_cache
+        self.assertLessEqual(len(cache), cache.maxsize)
+
 
 if __name__ == "__main__":
     unittest.main()
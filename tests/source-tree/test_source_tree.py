@@ -129,6 +129,26 @@ class TestSourceTree(unittest.TestCase):
         self.tree.visit(top_level_counter)
         self.assertEqual(top_level_counter.count, 5)
 
+    def test_finalize(self):
+        """Check that parsed trees store children as tuples"""
+        for node in self.tree.walk():
+            self.assertIsInstance(node.children, tuple)
+
+        # Children can still be added after the tree is finalized.
+        root = self.tree.root
+        count = len(root.children)
+        child = CodeNode()
+        root.add_child(child)
+        self.assertIsInstance(root.children, list)
+        self.assertEqual(len(root.children), count + 1)
+        self.assertIs(root.children[-1], child)
+        self.assertIs(child.parent, root)
+
+        # Finalizing a tree does not change how its nodes are printed.
+        for node in self.tree.walk():
+            if isinstance(node, DirectiveNode):
+                self.assertIn("(children=[", repr(node))
+
 
 if __name__ == "__main__":
     unittest.main()